@@ -4,11 +4,12 @@ import itertools
 
 from PyQt5 import QtWidgets
 from PyQt5.QtWidgets import QFileDialog, QGraphicsItem, QMenu, QAction, QMessageBox
-from PyQt5.QtGui import QKeyEvent, QPixmap, QImage
-from PyQt5.QtCore import Qt, QPointF, QPoint
-import cv2
-
+from PyQt5.QtGui import QKeyEvent
+from PyQt5.QtCore import Qt, QPointF, QPoint, pyqtSignal
 from utils.SAM import SA
+from utils.fileScanner import FileScanner
+from utils.imageCache import ImageCache, DisplayPrefetcher
+from utils.fileListModel import FileListModel, FileStatus
 from utils.format import AutoLabelFormat
 from utils.classSelectionDialog import load_classes_from_file, create_class_index_dictionary
 from utils.general import Data, parse_yolo, parse_xml, parse_coco, to_orig_pos, to_scaled_pos, save_yolo_format, save_pascal_format, save_coco_format, track_changes
@@ -16,14 +17,27 @@ import autoLabel_ui as ui
 
 
 class AutoLabel(QtWidgets.QMainWindow, ui.Ui_AutoLabel):
+    model_loaded = pyqtSignal()     # emitted from the loading thread, delivered on the GUI thread
+
     def __init__(self):
         super().__init__()
         self.setupUi(self)
 
         load_classes_from_file(Path("classes.txt"))
-        self.sam = SA(model_name="vit_b", model_path="sam_vit_b_01ec64.pth")
 
-        self.pixmap = None
+        # the window shows up right away, the model is loaded in the background
+        self.pending_predict = False
+        self.model_loaded.connect(self.on_model_loaded)
+        self.statusbar.showMessage("Loading SAM model...")
+        self.image_cache = ImageCache(max_bytes=1024**3)    # full resolution images shared by the view and the SAM encodes
+        self.display_prefetcher = DisplayPrefetcher(image_cache=self.image_cache)     # downscaled images for the view, decoded ahead
+        self.sam = SA(model_name="vit_b", model_path="sam_vit_b_01ec64.pth", cache_dir=".embeddings",
+                      background=True, on_loaded=self.model_loaded.emit, decoder="onnx", image_cache=self.image_cache)
+
+        self.image = None
+        self.scanner = None
+        self.fileModel = FileListModel(self)
+        self.fileList.setModel(self.fileModel)
         self.current_image_index = 0
         btn_cycle_texts = itertools.cycle([member.name for member in AutoLabelFormat])
         self.classes_mapping = create_class_index_dictionary()
@@ -37,7 +51,7 @@ class AutoLabel(QtWidgets.QMainWindow, ui.Ui_AutoLabel):
         self.saveBtn.clicked.connect(lambda: self.save(self.get_save_format()))
         self.classList.itemClicked.connect(self.highlight_clicked_item)
         self.classList.customContextMenuRequested.connect(self.show_tool_menu)
-        self.fileList.itemDoubleClicked.connect(lambda item: self.switch_img(self.fileList.row(item)))
+        self.fileList.doubleClicked.connect(lambda index: self.switch_img(index.row()))
 
     # override
     def keyPressEvent(self, event: QKeyEvent) -> None:
@@ -61,6 +75,7 @@ class AutoLabel(QtWidgets.QMainWindow, ui.Ui_AutoLabel):
 
             file_path, _ = QFileDialog.getOpenFileName(None, "Select file", "", "Image Files (*.jpg;*.jpeg;*.png;*.bmp;)")
             if file_path:
+                self.stop_scan()
                 self.show_file_path([file_path])
                 self.show_image(self.current_image_index)
 
@@ -71,38 +86,79 @@ class AutoLabel(QtWidgets.QMainWindow, ui.Ui_AutoLabel):
 
             folder_path = QFileDialog.getExistingDirectory(self, "Open folder", "./")
             if folder_path:
-                extensions = ["*.jpg", "*.jpeg", "*.png", "*.bmp"]
-                files = []
-                for ext in extensions:
-                    files.extend(Path(folder_path).glob(ext))
+                self.scan_dir(folder_path)
+
+
+    def scan_dir(self, folder_path: str) -> None:
+        self.stop_scan()
+        self.fileModel.clear()
+        self.clear_image()      # the folder may hold no image at all
+
+        # files are listed on a background thread and added in chunks, the first image is shown as soon as it is found
+        # subdirectories stay opt-in, COCO annotations are keyed by file name and images with the same name would overwrite each other
+        self.scanner = FileScanner(folder_path)
+        self.scanner.found.connect(self.add_file_paths)
+        self.scanner.finished.connect(lambda: self.statusbar.showMessage(f"{self.fileModel.rowCount()} images", 3000))
+        self.statusbar.showMessage(f"Scanning {folder_path}...")
+        self.scanner.start()
+
 
-                if files:
-                    self.show_file_path([str(img) for img in files])
-                    self.show_image(self.current_image_index)
+    def stop_scan(self) -> None:
+        if self.scanner is not None:
+            self.scanner.found.disconnect()
+            self.scanner.requestInterruption()
+            self.scanner.wait()
+            self.scanner = None
+
+
+    def add_file_paths(self, file_paths: list) -> None:
+        if self.sender() is not self.scanner:
+            return      # queued chunk of a scan that has been stopped
+
+        is_first_chunk = self.fileModel.rowCount() == 0
+        self.fileModel.add_paths(file_paths)
+
+        if is_first_chunk:
+            self.fileList.setCurrentIndex(self.fileModel.index(0))
+            self.show_image(self.current_image_index)
+
+
+    def clear_image(self) -> None:
+        self.image = None
+        self.current_image_index = 0
+        self.graphicsView.clear_image()
+
+
+    def has_image(self) -> bool:
+        return self.image is not None and self.current_image_index < self.fileModel.rowCount()
 
 
     def show_file_path(self, file_path: list) -> None:
-        self.fileList.clear()
-        self.fileList.addItems(file_path)
-        self.fileList.setCurrentItem(self.fileList.item(0))
+        self.fileModel.clear()
+        self.fileModel.add_paths(file_path)
+        self.fileList.setCurrentIndex(self.fileModel.index(0))
 
 
     def show_image(self, index: int) -> None:
-        image = cv2.imread(self.fileList.item(index).text())
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        height, width, channel = image.shape
-
-        bytesPerLine = 3 * width
-        self.pixmap = QPixmap.fromImage(QImage(image, width, height, bytesPerLine, QImage.Format_RGB888))
+        file_path = self.fileModel.path(index)
+        self.image = self.display_prefetcher.get(file_path, self.graphicsView.size())
 
         self.graphicsView.set_class_list(self.classList)
-        self.graphicsView.set_pixmap(self.pixmap)
-        self.show_boxes(Path(self.fileList.item(index).text()))
+        self.graphicsView.set_image(self.image.qimage, file_path, self.image.size())
+        self.show_boxes(Path(self.fileModel.path(index)))
+        self.prefetch_neighbours(index)
+
+
+    def prefetch_neighbours(self, index: int) -> None:
+        # encode the current, next and previous images in the background while the current one is labeled
+        neighbours = [i for i in (index, index+1, index-1) if 0 <= i < self.fileModel.rowCount()]
+        self.sam.prefetch([self.fileModel.path(i) for i in neighbours])
+        self.display_prefetcher.prefetch([self.fileModel.path(i) for i in neighbours[1:]], self.graphicsView.size())
     
 
     def show_boxes(self, file_path: Path) -> None:
         scaled_pixmap_size = self.graphicsView.get_scaled_pixmap().size()
-        ori_pixmap_size = self.pixmap.size()
+        ori_pixmap_size = self.image.size()
         scaled_h = scaled_pixmap_size.height()
         scaled_w = scaled_pixmap_size.width()
 
@@ -111,15 +167,17 @@ class AutoLabel(QtWidgets.QMainWindow, ui.Ui_AutoLabel):
             boxes = parse_yolo(str(file_path.with_suffix(".txt")), scaled_h, scaled_w)
         elif file_path.with_suffix(".xml").exists():
             boxes = parse_xml(str(file_path.with_suffix(".xml")), scaled_pixmap_size, ori_pixmap_size)
-        elif Path("annotations.json").exists():
+        elif (file_path.parent / "annotations.json").exists():
             boxes = parse_coco(str(file_path.parent / "annotations.json"), file_path.name, self.classes_mapping, scaled_pixmap_size, ori_pixmap_size)
 
         self.add_rects(boxes)
+        if boxes:
+            self.fileModel.add_status(self.current_image_index, FileStatus.LABELED)
 
 
     def next_img(self) -> None:
         if self.confirm_modified():
-            if self.current_image_index+1 < len(self.fileList):
+            if self.current_image_index+1 < self.fileModel.rowCount():
                 self.current_image_index += 1
                 self.switch_img(self.current_image_index)
 
@@ -135,19 +193,43 @@ class AutoLabel(QtWidgets.QMainWindow, ui.Ui_AutoLabel):
         if self.confirm_modified():
             self.current_image_index = index
             self.show_image(index)
-            self.fileList.setCurrentRow(index)
+            self.fileList.setCurrentIndex(self.fileModel.index(index))
+
+
+    def on_model_loaded(self) -> None:
+        if self.sam.load_error is not None:
+            self.statusbar.showMessage("Failed to load SAM model")
+            QMessageBox.critical(self, "Error", f"Failed to load SAM model:\n{self.sam.load_error}")
+            return
+
+        self.statusbar.showMessage("SAM model loaded", 3000)
+        if self.pending_predict:
+            self.pending_predict = False
+            self.predict_event()
 
 
     @track_changes
     def predict_event(self) -> None:
-        if self.pixmap is not None:
+        if self.has_image():
+            if not self.sam.is_ready():
+                # run the prediction as soon as the model is available
+                if self.sam.load_error is None:
+                    self.pending_predict = True
+                    self.statusbar.showMessage("Loading SAM model, prediction will run once it is ready...")
+                return
+
             scaled_size = self.graphicsView.get_scaled_pixmap().size()
-            ori_size = self.pixmap.size()
+            ori_size = self.image.size()
 
             labels, points = self.get_starts_label_coords()
             if labels and points:
-                image_path = self.fileList.currentItem().text()
-                x, y, w, h = self.sam.predict_box(image_path, points, labels)
+                image_path = self.fileModel.path(self.current_image_index)
+                bbox = self.sam.predict_box(image_path, points, labels)
+                if bbox is None:
+                    self.statusbar.showMessage("SAM found no object at the prompts", 3000)
+                    return
+                x, y, w, h = bbox
+                self.fileModel.add_status(self.current_image_index, FileStatus.PREDICTED)
 
                 topLeftPos = to_scaled_pos(x, y, scaled_size, ori_size)
                 bottomRightPos = to_scaled_pos(x+w, y+h, scaled_size, ori_size)
@@ -172,7 +254,7 @@ class AutoLabel(QtWidgets.QMainWindow, ui.Ui_AutoLabel):
             text = item.text()
             if text in label_mapping:
                 item_pos = item.data(Qt.UserRole).scenePos()
-                o_x, o_y = to_orig_pos(item_pos, self.graphicsView.get_scaled_pixmap().size(), self.pixmap.size())
+                o_x, o_y = to_orig_pos(item_pos, self.graphicsView.get_scaled_pixmap().size(), self.image.size())
 
                 labels.append(label_mapping[text])
                 points.append([o_x, o_y])
@@ -265,10 +347,10 @@ class AutoLabel(QtWidgets.QMainWindow, ui.Ui_AutoLabel):
         
 
     def save(self, format=None) -> None:
-        if self.pixmap is not None:
+        if self.has_image():
             scaled_size = self.graphicsView.get_scaled_pixmap().size()
-            ori_size = self.pixmap.size()
-            file_path = Path(self.fileList.currentItem().text())
+            ori_size = self.image.size()
+            file_path = Path(self.fileModel.path(self.current_image_index))
             options = QFileDialog.Options()
             
             if format == AutoLabelFormat.YOLO:
@@ -278,6 +360,7 @@ class AutoLabel(QtWidgets.QMainWindow, ui.Ui_AutoLabel):
             elif format == AutoLabelFormat.COCO:
                 save_coco_format(file_path, self.classList, self.classes_mapping, scaled_size, ori_size, options)
 
+            self.fileModel.add_status(self.current_image_index, FileStatus.LABELED)
             Data.is_modified = False
 
 if __name__ == "__main__":
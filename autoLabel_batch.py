@@ -0,0 +1,335 @@
+from typing import Iterator, List, Optional, Tuple
+from pathlib import Path
+import argparse
+import json
+import os
+import queue
+import threading
+
+from PyQt5.QtCore import QSize
+import numpy as np
+import torch
+import torch.multiprocessing
+import cv2
+
+from segment_anything import ImageEmbedding, SamAutomaticMaskGenerator
+from utils.SAM import SA, PRECISIONS
+from utils.batchTuning import BatchTuning, machine_id
+from utils.embeddingCache import checkpoint_id
+from utils.format import AutoLabelFormat
+from utils.fileScanner import iter_images
+from utils.classSelectionDialog import load_classes_from_file, create_class_index_dictionary
+from utils.general import parse_yolo, parse_xml, parse_coco, write_yolo_file, write_pascal_file, write_coco_file
+
+
+PROGRESS_FILE = "autolabel_progress.jsonl"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Annotate a directory of images with SAM without opening the window.")
+    parser.add_argument("source", type=str, help="directory of images")
+    parser.add_argument("--output", type=str, default=None, help="directory for the labels, defaults to the image directory")
+    parser.add_argument("--format", type=str, default=AutoLabelFormat.YOLO.name, choices=[member.name for member in AutoLabelFormat])
+    parser.add_argument("--mode", type=str, default="auto", choices=["auto", "prompt"],
+                        help="auto: SamAutomaticMaskGenerator, prompt: refine the boxes of existing label files")
+    parser.add_argument("--model-name", type=str, default="vit_b")
+    parser.add_argument("--model-path", type=str, default="sam_vit_b_01ec64.pth")
+    parser.add_argument("--cpu", action="store_true", help="do not use the GPU even if it is available")
+    parser.add_argument("--precision", type=str, default="fp32", choices=PRECISIONS, help="int8 and bf16 are CPU only")
+    parser.add_argument("--classes", type=str, default="classes.txt")
+    parser.add_argument("--label", type=str, default=None, help="class given to every mask in auto mode, defaults to the first class")
+    parser.add_argument("--points-per-side", type=int, default=32)
+    parser.add_argument("--pred-iou-thresh", type=float, default=0.88)
+    parser.add_argument("--stability-score-thresh", type=float, default=0.95)
+    parser.add_argument("--min-area", type=int, default=0, help="drop masks smaller than this many pixels")
+    parser.add_argument("--skip-covered-points", action="store_true",
+                        help="run the point grid coarse to fine and skip points inside confident masks already found")
+    parser.add_argument("--points-per-batch", type=int, default=64, help="point prompts decoded together in auto mode")
+    parser.add_argument("--autotune", action="store_true",
+                        help="time a few --points-per-batch values on the first image, the fastest is remembered per model and machine")
+    parser.add_argument("--autotune-max-mb", type=int, default=2048, help="skip batch sizes estimated to need more memory")
+    parser.add_argument("--tuning-file", type=str, default=".batch_tuning.json")
+    parser.add_argument("--queue-size", type=int, default=4, help="number of decoded images waiting for the model")
+    parser.add_argument("--batch-size", type=int, default=1, help="images encoded in one image encoder pass (prompt mode)")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes, each runs the model on its own images (CPU only)")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads per worker, defaults to cores / workers")
+    return parser.parse_args()
+
+def list_images(source: Path) -> List[Path]:
+    return [Path(path) for path in iter_images(str(source))]
+
+def load_progress(progress_path: Path) -> dict:
+    records = {}
+    if progress_path.exists():
+        with open(progress_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue    # last line of an interrupted run
+                records[record["file_name"]] = record
+
+    return records
+
+def read_images(files: List[Path], queue_size: int) -> Iterator[Tuple[Path, Optional[np.ndarray]]]:
+    # decode on a separate thread, the bounded queue keeps at most queue_size images in memory
+    image_queue = queue.Queue(maxsize=queue_size)
+
+    def reader() -> None:
+        for file in files:
+            image = cv2.imread(str(file))
+            if image is not None:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            image_queue.put((file, image))
+        image_queue.put(None)
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        item = image_queue.get()
+        if item is None:
+            break
+        yield item
+
+def load_prompt_boxes(file: Path, width: int, height: int, classes_mapping: dict) -> list:
+    # parse at original resolution, so the scaled size is the original size
+    size = QSize(width, height)
+    boxes = []
+    if file.with_suffix(".txt").exists():
+        boxes = parse_yolo(str(file.with_suffix(".txt")), height, width)
+    elif file.with_suffix(".xml").exists():
+        boxes = parse_xml(str(file.with_suffix(".xml")), size, size)
+    elif (file.parent / "annotations.json").exists():
+        boxes = parse_coco(str(file.parent / "annotations.json"), file.name, classes_mapping, size, size)
+
+    return [[classes, int(topLeft.x()), int(topLeft.y()), int(bottomRight.x()), int(bottomRight.y())]
+            for classes, topLeft, bottomRight in boxes if classes in classes_mapping]
+
+def predict_auto(generator: SamAutomaticMaskGenerator, image: np.ndarray, label: str, min_area: int) -> list:
+    boxes = []
+    for ann in generator.iter_generate(image):      # segmentations are never built
+        if ann["area"] < min_area:
+            continue
+        x, y, w, h = ann["bbox"]
+        boxes.append([label, int(x), int(y), int(x+w), int(y+h)])
+
+    return boxes
+
+def predict_prompt(sam: SA, embedding: ImageEmbedding, prompt_boxes: list) -> list:
+    if not prompt_boxes:
+        return []
+
+    boxes = []
+    sam.predictor.set_embedding(*embedding)
+    for classes, x1, y1, x2, y2 in prompt_boxes:
+        bbox = sam.predict_bbox(sam.predictor, box=np.array([x1, y1, x2, y2]))
+        if bbox is not None:
+            x, y, w, h = bbox
+            boxes.append([classes, x, y, x+w, y+h])
+        else:
+            boxes.append([classes, x1, y1, x2, y2])     # empty mask, keep the prompt box
+    sam.reset_image()
+
+    return boxes
+
+def write_labels(file: Path, record: dict, format: AutoLabelFormat, output_dir: Path, classes_mapping: dict) -> None:
+    width, height = record["width"], record["height"]
+
+    if format == AutoLabelFormat.YOLO:
+        bboxes = []
+        for classes, x1, y1, x2, y2 in record["boxes"]:
+            x, y = (x1+x2) / 2 / width, (y1+y2) / 2 / height
+            w, h = (x2-x1) / width, (y2-y1) / height
+            bboxes.append((classes_mapping[classes], x, y, w, h))
+        write_yolo_file(bboxes, str(output_dir / f"{file.stem}.txt"))
+    elif format == AutoLabelFormat.PascalVOC:
+        objects = []
+        for classes, x1, y1, x2, y2 in record["boxes"]:
+            objects.append({
+                "name": classes,
+                "pose": "Unspecified",
+                "truncated": "0",
+                "difficult": "0",
+                "xmin": max(0, x1),
+                "ymin": max(0, y1),
+                "xmax": max(0, x2),
+                "ymax": max(0, y2),
+            })
+        write_pascal_file(file.parent.name, file.name, str(file), width, height, objects, str(output_dir / f"{file.stem}.xml"))
+
+def build_coco(records: list, classes_mapping: dict) -> dict:
+    images, annotations = [], []
+    for image_id, record in enumerate(records):
+        images.append({
+            "id": image_id,
+            "file_name": record["file_name"],
+            "width": record["width"],
+            "height": record["height"]
+        })
+        for classes, x1, y1, x2, y2 in record["boxes"]:
+            annotations.append({
+                "iscrowd": 0,
+                "ignore": 0,
+                "image_id": image_id,
+                "bbox": [float(x1), float(y1), float(x2-x1), float(y2-y1)],
+                "area": float(x2-x1) * float(y2-y1),
+                "segmentation": [],
+                "category_id": classes_mapping[classes],
+                "id": len(annotations)
+            })
+
+    categories = [{"supercategory": "none", "id": id, "name": classes} for classes, id in classes_mapping.items()]
+    return {"images": images, "annotations": annotations, "categories": categories}
+
+def build_generator(sam: SA, args: argparse.Namespace) -> Optional[SamAutomaticMaskGenerator]:
+    if args.mode != "auto":
+        return None
+
+    return SamAutomaticMaskGenerator(
+        sam.sam,
+        points_per_side=args.points_per_side,
+        pred_iou_thresh=args.pred_iou_thresh,
+        stability_score_thresh=args.stability_score_thresh,
+        points_per_batch=args.points_per_batch,
+        skip_covered_points=args.skip_covered_points,
+    )
+
+def tune_generator(sam: SA, generator: SamAutomaticMaskGenerator, image: np.ndarray, args: argparse.Namespace) -> None:
+    tuning = BatchTuning(args.tuning_file)
+    key = f"{checkpoint_id(args.model_name, args.model_path)}:{args.precision}|{machine_id(sam.device())}"
+    entry = tuning.get(key)
+    if entry is not None:
+        generator.points_per_batch = entry["points_per_batch"]
+        print(f"points_per_batch {entry['points_per_batch']} ({entry['points_per_sec']} points/s), tuned earlier.")
+        return
+
+    with sam.precision_context():
+        points_per_sec = generator.autotune_points_per_batch(image, max_bytes=args.autotune_max_mb * 1024**2)
+    for points_per_batch, rate in points_per_sec.items():
+        print(f"points_per_batch {points_per_batch}: {rate:.1f} points/s")
+    print(f"points_per_batch {generator.points_per_batch} is the fastest, saved to \"{args.tuning_file}\".")
+    tuning.put(key, generator.points_per_batch, points_per_sec[generator.points_per_batch])
+
+def make_record(file: Path, image: np.ndarray, boxes: list) -> dict:
+    height, width = image.shape[:2]
+    return {"file_name": file.name, "width": width, "height": height, "boxes": boxes}
+
+def annotate_batch(sam: SA, generator: Optional[SamAutomaticMaskGenerator], args: argparse.Namespace, classes_mapping: dict,
+                   batch: List[Tuple[Path, Optional[np.ndarray]]]) -> Iterator[Tuple[Path, Optional[dict]]]:
+    if args.mode == "auto":
+        for file, image in batch:
+            if image is None:
+                yield file, None
+                continue
+            with sam.precision_context():
+                boxes = predict_auto(generator, image, args.label, args.min_area)
+            yield file, make_record(file, image, boxes)
+        return
+
+    # images without prompts never reach the image encoder, the rest share one encoder pass
+    prompts = {file: load_prompt_boxes(file, image.shape[1], image.shape[0], classes_mapping) for file, image in batch if image is not None}
+    encodable = [(file, image) for file, image in batch if prompts.get(file)]
+    embeddings = {}
+    if encodable:
+        with sam.precision_context():
+            embeddings = dict(zip([file for file, _ in encodable], sam.predictor.encode_images([image for _, image in encodable])))
+
+    for file, image in batch:
+        if image is None:
+            yield file, None
+            continue
+        with sam.precision_context():
+            boxes = predict_prompt(sam, embeddings.get(file), prompts[file])
+        yield file, make_record(file, image, boxes)
+
+def annotate_serial(files: List[Path], args: argparse.Namespace, classes_mapping: dict) -> Iterator[Tuple[Path, Optional[dict]]]:
+    sam = SA(model_name=args.model_name, model_path=args.model_path, gpu=not args.cpu, precision=args.precision)
+    generator = build_generator(sam, args)
+
+    tune = args.autotune and generator is not None
+    batch = []
+    for file, image in read_images(files, args.queue_size):
+        if tune and image is not None:
+            tune_generator(sam, generator, image, args)
+            tune = False
+        batch.append((file, image))
+        if len(batch) == args.batch_size:
+            yield from annotate_batch(sam, generator, args, classes_mapping, batch)
+            batch = []
+
+    yield from annotate_batch(sam, generator, args, classes_mapping, batch)
+
+# state of a pool worker, set once by init_worker
+worker = {}
+
+def init_worker(args: argparse.Namespace, model: torch.nn.Module, threads: int) -> None:
+    torch.set_num_threads(threads)
+    load_classes_from_file(Path(args.classes))     # spawned workers start with an empty class list
+
+    sam = SA(model_name=args.model_name, model_path=args.model_path, gpu=False, model=model, precision=args.precision)
+    generator = build_generator(sam, args)
+    worker.update(sam=sam, generator=generator, args=args, classes_mapping=create_class_index_dictionary(),
+                  tune=args.autotune and generator is not None)
+
+def annotate_file(file: Path) -> Tuple[Path, Optional[dict]]:
+    image = cv2.imread(str(file))
+    if image is not None:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    # every worker tunes on its first image, under the same load as the rest of the run
+    if worker["tune"] and image is not None:
+        tune_generator(worker["sam"], worker["generator"], image, worker["args"])
+        worker["tune"] = False
+
+    return next(annotate_batch(worker["sam"], worker["generator"], worker["args"], worker["classes_mapping"], [(file, image)]))
+
+def annotate_parallel(files: List[Path], args: argparse.Namespace) -> Iterator[Tuple[Path, Optional[dict]]]:
+    # load the fp32 weights once and move them to shared memory, workers receive handles instead of copies
+    model = SA(model_name=args.model_name, model_path=args.model_path, gpu=False).sam
+    model.share_memory()
+    threads = args.threads if args.threads > 0 else max(1, (os.cpu_count() or 1) // args.workers)
+
+    # each worker decodes its own image, so at most one image per worker is in memory
+    context = torch.multiprocessing.get_context("spawn")
+    with context.Pool(args.workers, initializer=init_worker, initargs=(args, model, threads)) as pool:
+        yield from pool.imap_unordered(annotate_file, files, chunksize=1)
+
+def main() -> None:
+    args = parse_args()
+    source = Path(args.source)
+    output_dir = Path(args.output) if args.output else source
+    output_dir.mkdir(parents=True, exist_ok=True)
+    format = AutoLabelFormat[args.format]
+
+    load_classes_from_file(Path(args.classes))
+    classes_mapping = create_class_index_dictionary()
+    args.label = args.label if args.label is not None else next(iter(classes_mapping))
+    assert args.label in classes_mapping, f"\"{args.label}\" is not in \"{args.classes}\"."
+
+    # every finished image is appended to the progress file, a rerun skips them
+    progress_path = output_dir / PROGRESS_FILE
+    records = load_progress(progress_path)
+    files = [file for file in list_images(source) if file.name not in records]
+    print(f"{len(records)} images already annotated, {len(files)} to go.")
+
+    if args.workers > 1:
+        results = annotate_parallel(files, args)
+    else:
+        results = annotate_serial(files, args, classes_mapping)
+
+    with open(progress_path, "a") as progress:
+        for file, record in results:
+            if record is None:
+                print(f"Cannot read \"{file}\", skipped.")
+                continue
+
+            write_labels(file, record, format, output_dir, classes_mapping)
+            progress.write(json.dumps(record) + "\n")
+            progress.flush()
+            records[file.name] = record
+
+    # built from the progress file at the end, so prompt mode never reads a half-written annotations.json
+    if format == AutoLabelFormat.COCO:
+        write_coco_file(build_coco(list(records.values()), classes_mapping), str(output_dir / "annotations.json"))
+
+if __name__ == "__main__":
+    main()
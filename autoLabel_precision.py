@@ -0,0 +1,82 @@
+from typing import List, Optional, Tuple
+from pathlib import Path
+import argparse
+import time
+
+import numpy as np
+
+from utils.SAM import SA, PRECISIONS
+from utils.fileScanner import iter_images
+from utils.imageCache import ImageCache
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare the boxes predicted with a reduced precision against fp32 on CPU.")
+    parser.add_argument("source", type=str, help="directory of sample images")
+    parser.add_argument("--precision", type=str, default="int8", choices=[p for p in PRECISIONS if p != "fp32"])
+    parser.add_argument("--model-name", type=str, default="vit_b")
+    parser.add_argument("--model-path", type=str, default="sam_vit_b_01ec64.pth")
+    parser.add_argument("--points-per-side", type=int, default=3, help="a grid of single point prompts per image")
+    parser.add_argument("--max-images", type=int, default=20)
+    return parser.parse_args()
+
+def box_iou(box1: Tuple[int, int, int, int], box2: Tuple[int, int, int, int]) -> float:
+    x1, y1, w1, h1 = box1
+    x2, y2, w2, h2 = box2
+    inter_w = max(0, min(x1+w1, x2+w2) - max(x1, x2))
+    inter_h = max(0, min(y1+h1, y2+h2) - max(y1, y2))
+    inter = inter_w * inter_h
+    union = w1*h1 + w2*h2 - inter
+
+    return inter / union if union > 0 else 1.0
+
+def grid_points(height: int, width: int, n_per_side: int) -> List[List[int]]:
+    xs = np.linspace(0, width, n_per_side + 2)[1:-1]
+    ys = np.linspace(0, height, n_per_side + 2)[1:-1]
+    return [[int(x), int(y)] for y in ys for x in xs]
+
+def predict(sam: SA, img_path: str, point: List[int]) -> Optional[Tuple[int, int, int, int]]:
+    return sam.predict_box(img_path, [point], [1])     # None for an empty mask
+
+def timed_set_image(sam: SA, img_path: str) -> float:
+    start = time.perf_counter()
+    sam.set_image(img_path)
+    return time.perf_counter() - start
+
+def main() -> None:
+    args = parse_args()
+    files = [Path(path) for path in iter_images(args.source)][:args.max_images]
+    assert files, f"No images in \"{args.source}\"."
+
+    # both models encode the same decoded images, a sample is decoded once
+    image_cache = ImageCache(max_bytes=512 * 1024**2)
+    reference = SA(model_name=args.model_name, model_path=args.model_path, gpu=False, image_cache=image_cache)
+    candidate = SA(model_name=args.model_name, model_path=args.model_path, gpu=False, precision=args.precision, image_cache=image_cache)
+
+    ious, reference_times, candidate_times = [], [], []
+    for file in files:
+        img_path = str(file)
+        image = image_cache.get(img_path)
+        height, width = image.height, image.width
+
+        reference_times.append(timed_set_image(reference, img_path))
+        candidate_times.append(timed_set_image(candidate, img_path))
+
+        for point in grid_points(height, width, args.points_per_side):
+            reference_box = predict(reference, img_path, point)
+            candidate_box = predict(candidate, img_path, point)
+            if reference_box is None or candidate_box is None:
+                ious.append(1.0 if reference_box == candidate_box else 0.0)
+            else:
+                ious.append(box_iou(reference_box, candidate_box))
+
+        print(f"{file.name}: fp32 {reference_times[-1]:.2f}s, {args.precision} {candidate_times[-1]:.2f}s")
+
+    ious = np.array(ious)
+    print(f"\n{len(files)} images, {len(ious)} prompts")
+    print(f"box IoU vs fp32: mean {ious.mean():.4f}, min {ious.min():.4f}, >= 0.9: {(ious >= 0.9).mean():.1%}")
+    print(f"encode time: fp32 {np.mean(reference_times):.2f}s, {args.precision} {np.mean(candidate_times):.2f}s "
+          f"({np.mean(reference_times) / np.mean(candidate_times):.2f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -219,10 +219,13 @@ class Ui_AutoLabel(object):
         self.fileList_label.setAlignment(QtCore.Qt.AlignCenter)
         self.fileList_label.setObjectName("fileList_label")
         self.verticalLayout_2.addWidget(self.fileList_label)
-        self.fileList = QtWidgets.QListWidget(self.verticalLayoutWidget_2)
+        self.fileList = QtWidgets.QListView(self.verticalLayoutWidget_2)
         font = QtGui.QFont()
         font.setPointSize(9)
         self.fileList.setFont(font)
+        self.fileList.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.fileList.setLayoutMode(QtWidgets.QListView.Batched)
+        self.fileList.setUniformItemSizes(True)
         self.fileList.setObjectName("fileList")
         self.verticalLayout_2.addWidget(self.fileList)
         self.horizontalLayout.addWidget(self.splitter_2)
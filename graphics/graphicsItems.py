@@ -1,9 +1,13 @@
-from PyQt5.QtWidgets import QGraphicsRectItem, QGraphicsItem, QGraphicsPolygonItem
-from PyQt5.QtGui import QBrush, QColor, QPainter, QPen, QKeyEvent, QPolygonF, QPainterPath
-from PyQt5.QtCore import Qt, QRectF, QLineF, QPoint
+from collections import OrderedDict
+import math
+
+from PyQt5.QtWidgets import QGraphicsRectItem, QGraphicsItem, QGraphicsPolygonItem, QGraphicsPixmapItem
+from PyQt5.QtGui import QBrush, QColor, QPainter, QPen, QKeyEvent, QPolygonF, QPainterPath, QPixmap, QImage
+from PyQt5.QtCore import Qt, QRectF, QLineF, QPoint, QSize
 from PyQt5.QtWidgets import QGraphicsSceneHoverEvent, QGraphicsSceneMouseEvent
 
 from utils.general import track_changes
+from utils.tileLoader import TileLoader, TILE_SIZE
 
 
 class AlRectItem(QGraphicsRectItem):
@@ -292,4 +296,88 @@ class AlStartItem(QGraphicsPolygonItem):
     
     # override
     def boundingRect(self):
-        return QRectF(-5, -5, 10, 10)
\ No newline at end of file
+        return QRectF(-5, -5, 10, 10)
+
+
+class AlTiledPixmapItem(QGraphicsPixmapItem):
+    """
+    The scaled overview pixmap, with tiles of a finer pyramid level drawn over it when the view is zoomed in.
+
+    Item coordinates stay those of the overview, so boxes keep mapping through to_orig_pos/to_scaled_pos.
+    Tiles are decoded lazily for the visible area only and kept in a small LRU.
+    """
+    def __init__(self, pixmap: QPixmap, img_path: str, original_size: QSize, max_tiles: int = 192, parent=None) -> None:
+        super().__init__(pixmap, parent)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)      # exposedRect is the visible part only
+        self.setTransformationMode(Qt.SmoothTransformation)
+
+        self.scale_x = pixmap.width() / original_size.width()      # overview pixels per original pixel
+        self.scale_y = pixmap.height() / original_size.height()
+        self.max_level = max(0, math.ceil(math.log2(1 / self.scale_x)))
+
+        self.tiles = OrderedDict()      # (level, column, row) -> QPixmap
+        self.max_tiles = max_tiles
+        self.loader = TileLoader(img_path, original_size)
+        self.loader.loaded.connect(self.add_tile)
+
+    # override
+    def paint(self, painter, option, widget=None) -> None:
+        super().paint(painter, option, widget)
+
+        # original pixels per screen pixel decides the level, the overview is enough until it gets magnified
+        zoom = option.levelOfDetailFromTransform(painter.worldTransform())
+        if zoom <= 1.0:
+            self.loader.request([])
+            return
+        level = min(self.max_level, max(self.loader.min_level, math.floor(math.log2(1 / (self.scale_x * zoom)))))
+        if (1 << level) * self.scale_x >= 1.0:
+            self.loader.request([])
+            return      # this level has no more detail than the overview
+
+        # tiles are wanted for the whole viewport, a partial repaint (a loaded tile, a scrolled strip) only
+        # exposes a part of it and must not cancel the tiles queued for the rest
+        visible = option.exposedRect
+        if widget is not None:
+            inverted, invertible = painter.worldTransform().inverted()
+            if invertible:
+                visible = inverted.mapRect(QRectF(widget.rect())).intersected(self.boundingRect())
+
+        span = TILE_SIZE << level
+        first_column = max(0, int(visible.left() / self.scale_x) // span)
+        last_column = int(visible.right() / self.scale_x) // span
+        first_row = max(0, int(visible.top() / self.scale_y) // span)
+        last_row = int(visible.bottom() / self.scale_y) // span
+
+        missing = []
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                key = (level, column, row)
+                tile = self.tiles.get(key)
+                if tile is None:
+                    missing.append(key)
+                    continue
+
+                self.tiles.move_to_end(key)
+                target = self.to_item_rect(self.loader.tile_rect(key))
+                if target.intersects(option.exposedRect):
+                    painter.drawPixmap(target, tile, QRectF(tile.rect()))
+
+        self.loader.request(missing)
+
+    def to_item_rect(self, rect) -> QRectF:
+        return QRectF(rect.x() * self.scale_x, rect.y() * self.scale_y, rect.width() * self.scale_x, rect.height() * self.scale_y)
+
+    def add_tile(self, key: tuple, image: QImage) -> None:
+        if image.isNull():
+            return
+
+        self.tiles[key] = QPixmap.fromImage(image)
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        self.update(self.to_item_rect(self.loader.tile_rect(key)))
+
+    def close(self) -> None:
+        self.loader.loaded.disconnect()
+        self.loader.close()
+        self.tiles.clear()
@@ -1,9 +1,11 @@
 from PyQt5 import QtWidgets
 from PyQt5.QtWidgets import QGraphicsPixmapItem, QListWidget
-from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QPixmap, QImage
+from PyQt5.QtCore import Qt, QSize, QRectF
 
 from graphics.graphicsScenes import AlGraphicsScene
+from graphics.graphicsItems import AlTiledPixmapItem
+from utils.tileLoader import can_tile
 
 
 class AlGraphicsView(QtWidgets.QGraphicsView):
@@ -14,24 +16,65 @@ class AlGraphicsView(QtWidgets.QGraphicsView):
         self.scaled_pixmap_item = None
         self.scene_available = False
 
+        # zoom (ctrl + wheel) only changes the view transform, scene coordinates stay those of the scaled pixmap
+        self.max_zoom = 1.0
+        self.setTransformationAnchor(QtWidgets.QGraphicsView.AnchorUnderMouse)
+
     def set_class_list(self, class_list: QListWidget) -> None:
         self.class_list = class_list
 
-    def set_pixmap(self, pixmap: QPixmap) -> None:
+    def set_image(self, image: QImage, img_path: str = None, original_size: QSize = None) -> None:
         if not self.scene_available:
             self.scene_available = True
             self.al_scene = AlGraphicsScene(class_list=self.class_list)
             self.setScene(self.al_scene)
 
         
+        if isinstance(self.scaled_pixmap_item, AlTiledPixmapItem):
+            self.scaled_pixmap_item.close()
         self.al_scene.clear()       # initial data
         self.class_list.clear()     # initial data
         
-        self.scaled_pixmap = pixmap.scaled(self.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        self.scaled_pixmap_item = QGraphicsPixmapItem(self.scaled_pixmap)
+        # only the scaled copy becomes a pixmap, the full resolution image stays in the decoded buffer
+        self.scaled_pixmap = QPixmap.fromImage(image.scaled(self.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        self.resetTransform()
+        self.max_zoom = 1.0
+        if img_path is not None and original_size is not None and original_size.width() > self.scaled_pixmap.width() and can_tile(img_path):
+            # finer pyramid levels are decoded tile by tile once the view is zoomed in
+            self.scaled_pixmap_item = AlTiledPixmapItem(self.scaled_pixmap, img_path, original_size)
+            self.max_zoom = 4 * original_size.width() / self.scaled_pixmap.width()
+        else:
+            self.scaled_pixmap_item = QGraphicsPixmapItem(self.scaled_pixmap)
         self.al_scene.addItem(self.scaled_pixmap_item)
         self.al_scene.setSceneRect(self.scaled_pixmap_item.boundingRect())
         self.al_scene.set_pixmap_and_rect(self.scaled_pixmap_item)
 
+    def clear_image(self) -> None:
+        # nothing to show, e.g. an opened folder without images
+        if not self.scene_available:
+            return
+
+        if isinstance(self.scaled_pixmap_item, AlTiledPixmapItem):
+            self.scaled_pixmap_item.close()
+        self.al_scene.clear()
+        self.class_list.clear()
+        self.scaled_pixmap = None
+        self.scaled_pixmap_item = None
+        self.al_scene.pixmap_item = None
+        self.al_scene.pixmap_scene_rect = QRectF()      # clicks fall outside of it
+        self.resetTransform()
+        self.max_zoom = 1.0
+
+    # override
+    def wheelEvent(self, event) -> None:
+        if event.modifiers() == Qt.ControlModifier and self.max_zoom > 1.0:
+            factor = 1.25 if event.angleDelta().y() > 0 else 0.8
+            zoom = min(max(self.transform().m11() * factor, 1.0), self.max_zoom)
+            factor = zoom / self.transform().m11()
+            self.scale(factor, factor)
+            return
+
+        return super().wheelEvent(event)
+
     def get_scaled_pixmap(self) -> QPixmap:
         return self.scaled_pixmap
\ No newline at end of file
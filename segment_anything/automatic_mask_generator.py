@@ -8,30 +8,56 @@ import numpy as np
 import torch
 from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 
-from typing import Any, Dict, List, Optional, Tuple
+import time
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Tuple
 
 from .modeling import Sam
 from .predictor import SamPredictor
 from .utils.amg import (
+    CroppedMasks,
     MaskData,
-    area_from_rle,
+    MaskUpscaler,
     batch_iterator,
     batched_mask_to_box,
     box_xyxy_to_xywh,
+    coarse_to_fine_order,
     build_all_layer_point_grids,
-    calculate_stability_score,
     coco_encode_rle,
     generate_crop_boxes,
     is_box_near_crop_edge,
-    mask_to_rle_pytorch,
-    remove_small_regions,
-    rle_to_mask,
+    remove_small_regions_cropped,
     uncrop_boxes_xyxy,
-    uncrop_masks,
     uncrop_points,
 )
 
 
+class MaskRecord(Mapping):
+    """
+    A mask record as yielded by SamAutomaticMaskGenerator.iter_generate. The
+    segmentation is encoded on first lookup and kept, dict(record) gives the
+    record returned by generate.
+    """
+
+    def __init__(self, fields: Dict[str, Any], segmentation: Callable[[], Any]) -> None:
+        self._fields = fields
+        self._segmentation = segmentation
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "segmentation" and "segmentation" not in self._fields:
+            self._fields = {"segmentation": self._segmentation(), **self._fields}
+            self._segmentation = None
+        return self._fields[key]
+
+    def __iter__(self) -> Iterator[str]:
+        if "segmentation" in self._fields:
+            return iter(self._fields)
+        return iter(("segmentation", *self._fields))
+
+    def __len__(self) -> int:
+        return len(self._fields) + ("segmentation" not in self._fields)
+
+
 class SamAutomaticMaskGenerator:
     def __init__(
         self,
@@ -49,6 +75,9 @@ class SamAutomaticMaskGenerator:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        skip_covered_points: bool = False,
+        coverage_iou_thresh: float = 0.95,
+        coverage_stability_thresh: float = 0.97,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -93,6 +122,15 @@ class SamAutomaticMaskGenerator:
             'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
             For large resolutions, 'binary_mask' may consume large amounts of
             memory.
+          skip_covered_points (bool): If True, the points of a crop are run
+            from coarse to fine, and points that fall inside a confident mask
+            found by an earlier batch are skipped. Saves decoder runs on
+            images with large objects, at the cost of some masks of parts
+            inside those objects.
+          coverage_iou_thresh (float): The predicted IoU a mask needs to
+            count as confident for skip_covered_points.
+          coverage_stability_thresh (float): The stability score a mask needs
+            to count as confident for skip_covered_points.
         """
 
         assert (points_per_side is None) != (
@@ -132,6 +170,9 @@ class SamAutomaticMaskGenerator:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.skip_covered_points = skip_covered_points
+        self.coverage_iou_thresh = coverage_iou_thresh
+        self.coverage_stability_thresh = coverage_stability_thresh
 
     @torch.no_grad()
     def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
@@ -159,6 +200,28 @@ class SamAutomaticMaskGenerator:
                  the mask, given in XYWH format.
         """
 
+        return [dict(record) for record in self.iter_generate(image)]
+
+    @torch.no_grad()
+    def iter_generate(self, image: np.ndarray) -> Iterator[Mapping[str, Any]]:
+        """
+        Generates masks for the given image, yielding the records one at a
+        time instead of building the whole list.
+
+        Deduplication runs on the boxes of all crops before the first record
+        is yielded, the masks are held cropped to their boxes meanwhile. The
+        segmentation of a record is only built when it is looked up, so
+        consumers that only need the boxes never expand a mask to the image
+        size.
+
+        Arguments:
+          image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+
+        Returns:
+          (iterator(MaskRecord)): Read-only records with the keys of the
+            records returned by generate.
+        """
+
         # Generate masks
         mask_data = self._generate_masks(image)
 
@@ -170,29 +233,28 @@ class SamAutomaticMaskGenerator:
                 max(self.box_nms_thresh, self.crop_nms_thresh),
             )
 
-        # Encode masks
-        if self.output_mode == "coco_rle":
-            mask_data["segmentations"] = [coco_encode_rle(rle) for rle in mask_data["rles"]]
-        elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
-        else:
-            mask_data["segmentations"] = mask_data["rles"]
-
         # Write mask records
-        curr_anns = []
-        for idx in range(len(mask_data["segmentations"])):
-            ann = {
-                "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
+        masks = mask_data["masks"]
+        areas = masks.areas()
+        for idx in range(len(masks)):
+            fields = {
+                "area": int(areas[idx]),
                 "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
                 "predicted_iou": mask_data["iou_preds"][idx].item(),
                 "point_coords": [mask_data["points"][idx].tolist()],
                 "stability_score": mask_data["stability_score"][idx].item(),
                 "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
             }
-            curr_anns.append(ann)
+            yield MaskRecord(fields, partial(self._encode_segmentation, masks[[idx]]))
 
-        return curr_anns
+    def _encode_segmentation(self, masks: CroppedMasks) -> Any:
+        # Encodes the only mask of masks, straight from its crop
+        if self.output_mode == "binary_mask":
+            return masks.to_mask(0)
+        rle = masks.to_rle()[0]
+        if self.output_mode == "coco_rle":
+            return coco_encode_rle(rle)
+        return rle
 
     def _generate_masks(self, image: np.ndarray) -> MaskData:
         orig_size = image.shape[:2]
@@ -240,11 +302,16 @@ class SamAutomaticMaskGenerator:
         points_for_image = self.point_grids[crop_layer_idx] * points_scale
 
         # Generate masks for this crop in batches
-        data = MaskData()
-        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
-            data.cat(batch_data)
-            del batch_data
+        if self.skip_covered_points:
+            data = self._process_points_coarse_to_fine(
+                points_for_image, cropped_im_size, crop_box, orig_size
+            )
+        else:
+            data = MaskData()
+            for (points,) in batch_iterator(self.points_per_batch, points_for_image):
+                batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
+                data.cat(batch_data)
+                del batch_data
         self.predictor.reset_image()
 
         # Remove duplicates within this crop.
@@ -259,8 +326,38 @@ class SamAutomaticMaskGenerator:
         # Return to the original image frame
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["points"] = uncrop_points(data["points"], crop_box)
-        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
+        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["masks"]))])
+
+        return data
+
+    def _process_points_coarse_to_fine(
+        self,
+        points: np.ndarray,
+        im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+    ) -> MaskData:
+        # A point inside a confident mask mostly decodes to that mask again,
+        # such points are dropped before they reach the model. Coarse points
+        # go first so large objects are found early and cover many others.
+        pending = points[coarse_to_fine_order(points)]
+        crop_offset = np.array(crop_box[:2])[None, :]
+
+        data = MaskData()
+        while len(pending) > 0:
+            batch = pending[: self.points_per_batch]
+            pending = pending[self.points_per_batch :]
+            batch_data = self._process_batch(batch, im_size, crop_box, orig_size)
 
+            confident = (batch_data["iou_preds"] >= self.coverage_iou_thresh) & (
+                batch_data["stability_score"] >= self.coverage_stability_thresh
+            )
+            if len(pending) > 0 and confident.any():
+                covered = batch_data["masks"][confident].contains(pending + crop_offset)
+                pending = pending[~covered]
+
+            data.cat(batch_data)
+            del batch_data
         return data
 
     def _process_batch(
@@ -272,54 +369,108 @@ class SamAutomaticMaskGenerator:
     ) -> MaskData:
         orig_h, orig_w = orig_size
 
-        # Run model on this batch
+        # Run model on this batch, the masks are kept at low resolution
         transformed_points = self.predictor.transform.apply_coords(points, im_size)
         in_points = torch.as_tensor(transformed_points, device=self.predictor.device)
         in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
-        masks, iou_preds, _ = self.predictor.predict_torch(
+        low_res_masks, iou_preds = self.predictor.predict_low_res_torch(
             in_points[:, None, :],
             in_labels[:, None],
             multimask_output=True,
-            return_logits=True,
         )
 
         # Serialize predictions and store in MaskData
         data = MaskData(
-            masks=masks.flatten(0, 1),
+            low_res_masks=low_res_masks.flatten(0, 1),
             iou_preds=iou_preds.flatten(0, 1),
-            points=torch.as_tensor(points.repeat(masks.shape[1], axis=0)),
+            points=torch.as_tensor(points.repeat(low_res_masks.shape[1], axis=0)),
         )
-        del masks
+        del low_res_masks
 
         # Filter by predicted IoU
         if self.pred_iou_thresh > 0.0:
             keep_mask = data["iou_preds"] > self.pred_iou_thresh
             data.filter(keep_mask)
 
-        # Calculate stability score
-        data["stability_score"] = calculate_stability_score(
-            data["masks"], self.predictor.model.mask_threshold, self.stability_score_offset
+        # Upscale and threshold each mask only around the pixels above the
+        # low stability threshold, keeping it cropped to its box in the
+        # original image frame
+        upscaler = MaskUpscaler(
+            self.predictor.model.image_encoder.img_size,
+            self.predictor.input_size,
+            im_size,
+            low_res_size=data["low_res_masks"].shape[-1],
+        )
+        crops, data["boxes"], data["stability_score"] = upscaler.crop_masks(
+            data["low_res_masks"], self.predictor.model.mask_threshold, self.stability_score_offset
         )
+        del data["low_res_masks"]
+        offsets = data["boxes"][:, :2].cpu().numpy() + np.array(crop_box[:2])
+        data["masks"] = CroppedMasks(crops, offsets, orig_size)
+
+        # Filter by stability score
         if self.stability_score_thresh > 0.0:
             keep_mask = data["stability_score"] >= self.stability_score_thresh
             data.filter(keep_mask)
 
-        # Threshold masks and calculate boxes
-        data["masks"] = data["masks"] > self.predictor.model.mask_threshold
-        data["boxes"] = batched_mask_to_box(data["masks"])
-
         # Filter boxes that touch crop boundaries
         keep_mask = ~is_box_near_crop_edge(data["boxes"], crop_box, [0, 0, orig_w, orig_h])
         if not torch.all(keep_mask):
             data.filter(keep_mask)
 
-        # Compress to RLE
-        data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
-        data["rles"] = mask_to_rle_pytorch(data["masks"])
-        del data["masks"]
-
         return data
 
+    @torch.no_grad()
+    def autotune_points_per_batch(
+        self,
+        image: np.ndarray,
+        candidates: Tuple[int, ...] = (16, 32, 64, 128, 256),
+        max_bytes: int = 2 * 1024**3,
+    ) -> Dict[int, float]:
+        """
+        Times a batch of point prompts on the given image for each of the
+        candidate batch sizes and sets points_per_batch to the fastest. The
+        best batch size depends on the device, the number of threads and the
+        image size, so tune on an image representative of the ones to come.
+
+        Arguments:
+          image (np.ndarray): The image to time the batches on, in HWC uint8 format.
+          candidates (tuple(int)): The batch sizes to try.
+          max_bytes (int): Batch sizes whose estimated peak memory exceeds
+            this are skipped. The smallest candidate is always tried.
+
+        Returns:
+          (dict(int, float)): The measured points per second by batch size.
+            Sizes past the peak throughput are not timed.
+        """
+        orig_h, orig_w = orig_size = image.shape[:2]
+        crop_box = [0, 0, orig_w, orig_h]
+        points = self.point_grids[0] * np.array(orig_size)[None, ::-1]
+
+        # Three masks per point: the low resolution logits and, at worst,
+        # a crop of the whole image at one bit per pixel. The masks are
+        # upscaled one at a time, which adds one image of logits per batch
+        low_res_h, low_res_w = self.predictor.model.prompt_encoder.mask_input_size
+        bytes_per_point = 3 * (4 * low_res_h * low_res_w + orig_h * orig_w // 8)
+        candidates = sorted(candidates)
+        fitting = [n for n in candidates if n * bytes_per_point <= max_bytes] or candidates[:1]
+
+        self.predictor.set_image(image)
+        self._process_batch(points[: fitting[0]], orig_size, crop_box, orig_size)  # warm up
+
+        points_per_sec: Dict[int, float] = {}
+        for n in fitting:
+            batch = np.resize(points, (n, 2))  # repeats the grid if it has fewer points
+            start = time.perf_counter()
+            self._process_batch(batch, orig_size, crop_box, orig_size)
+            points_per_sec[n] = n / (time.perf_counter() - start)
+            if points_per_sec[n] < 0.8 * max(points_per_sec.values()):
+                break  # larger batches only get slower from here
+        self.predictor.reset_image()
+
+        self.points_per_batch = max(points_per_sec, key=points_per_sec.__getitem__)
+        return points_per_sec
+
     @staticmethod
     def postprocess_small_regions(
         mask_data: MaskData, min_area: int, nms_thresh: float
@@ -332,28 +483,38 @@ class SamAutomaticMaskGenerator:
 
         Requires open-cv as a dependency.
         """
-        if len(mask_data["rles"]) == 0:
+        masks = mask_data["masks"]
+        if len(masks) == 0:
             return mask_data
 
-        # Filter small disconnected regions and holes
-        new_masks = []
+        # Filter small disconnected regions and holes, on the cropped masks
+        new_crops = []
+        new_offsets = masks.offsets.copy()
         scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
+        for i in range(len(masks)):
+            offset = tuple(masks.offsets[i])
+            mask, offset, changed = remove_small_regions_cropped(
+                masks.crop(i), min_area, "holes", offset, masks.image_size
+            )
             unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
+            mask, offset, changed = remove_small_regions_cropped(
+                mask, min_area, "islands", offset, masks.image_size
+            )
             unchanged = unchanged and not changed
 
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
+            if not unchanged and mask.any():
+                # The box can shrink (removed islands) or grow (filled holes), crop again
+                x0, y0, x1, y1 = batched_mask_to_box(torch.as_tensor(mask)).tolist()
+                mask = mask[y0 : y1 + 1, x0 : x1 + 1]
+                new_offsets[i] = (offset[0] + x0, offset[1] + y0)
+            new_crops.append(mask)
             # Give score=0 to changed masks and score=1 to unchanged masks
             # so NMS will prefer ones that didn't need postprocessing
             scores.append(float(unchanged))
 
         # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
-        boxes = batched_mask_to_box(masks)
+        new_masks = CroppedMasks(new_crops, new_offsets, masks.image_size)
+        boxes = new_masks.boxes()
         keep_by_nms = batched_nms(
             boxes.float(),
             torch.as_tensor(scores),
@@ -361,12 +522,11 @@ class SamAutomaticMaskGenerator:
             iou_threshold=nms_thresh,
         )
 
-        # Only recalculate RLEs for masks that have changed
+        # Unchanged masks keep their crop, so only the boxes of changed masks are updated
         for i_mask in keep_by_nms:
             if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
                 mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
+        mask_data["masks"] = new_masks
         mask_data.filter(keep_by_nms)
 
         return mask_data
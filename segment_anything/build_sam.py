@@ -101,7 +101,17 @@ def _build_sam(
     )
     sam.eval()
     if checkpoint is not None:
-        with open(checkpoint, "rb") as f:
-            state_dict = torch.load(f)
+        state_dict = _load_checkpoint(checkpoint)
         sam.load_state_dict(state_dict)
     return sam
+
+
+def _load_checkpoint(checkpoint):
+    # Memory-map the checkpoint so tensors are paged in while being copied
+    # into the model, instead of reading the whole file up front.
+    try:
+        return torch.load(checkpoint, map_location="cpu", mmap=True, weights_only=True)
+    except TypeError:
+        # torch < 2.1 has no mmap argument
+        with open(checkpoint, "rb") as f:
+            return torch.load(f, map_location="cpu")
@@ -6,14 +6,28 @@
 
 import numpy as np
 import torch
+from torch.nn import functional as F
 
 from segment_anything.modeling import Sam
 
-from typing import Optional, Tuple
+from typing import List, NamedTuple, Optional, Tuple
 
+from .utils.amg import batched_mask_to_box
 from .utils.transforms import ResizeLongestSide
 
 
+class ImageEmbedding(NamedTuple):
+    """
+    The image embeddings of one image together with the sizes needed to
+    map prompts and masks, as returned by SamPredictor.encode_images.
+    Can be passed to SamPredictor.set_embedding as set_embedding(*embedding).
+    """
+
+    features: torch.Tensor
+    original_size: Tuple[int, ...]
+    input_size: Tuple[int, ...]
+
+
 class SamPredictor:
     def __init__(
         self,
@@ -89,6 +103,113 @@ class SamPredictor:
         self.features = self.model.image_encoder(input_image)
         self.is_image_set = True
 
+    def encode_images(
+        self,
+        images: List[np.ndarray],
+        image_format: str = "RGB",
+    ) -> List[ImageEmbedding]:
+        """
+        Calculates the image embeddings for several images in a single
+        forward pass of the image encoder. The currently set image is not
+        changed; use 'set_embedding' to predict masks for one of the results.
+
+        Arguments:
+          images (list(np.ndarray)): The images for calculating embeddings.
+            Expects images in HWC uint8 format, with pixel values in [0, 255].
+            The images may have different sizes.
+          image_format (str): The color format of the images, in ['RGB', 'BGR'].
+
+        Returns:
+          (list(ImageEmbedding)): The embeddings, in the order of 'images'.
+        """
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+
+        transformed_images, original_sizes = [], []
+        for image in images:
+            if image_format != self.model.image_format:
+                image = image[..., ::-1]
+            input_image = self.transform.apply_image(image)
+            input_image_torch = torch.as_tensor(input_image, device=self.device)
+            transformed_images.append(input_image_torch.permute(2, 0, 1).contiguous())
+            original_sizes.append(image.shape[:2])
+
+        return self.encode_torch_images(transformed_images, original_sizes)
+
+    @torch.no_grad()
+    def encode_torch_images(
+        self,
+        transformed_images: List[torch.Tensor],
+        original_image_sizes: List[Tuple[int, ...]],
+    ) -> List[ImageEmbedding]:
+        """
+        Calculates the image embeddings for several images in a single
+        forward pass of the image encoder. Expects the input images to be
+        already transformed to the format expected by the model.
+
+        Arguments:
+          transformed_images (list(torch.Tensor)): The input images, each with
+            shape 3xHxW, which have been transformed with ResizeLongestSide.
+          original_image_sizes (list(tuple(int, int))): The sizes of the images
+            before transformation, in (H, W) format.
+
+        Returns:
+          (list(ImageEmbedding)): The embeddings, in the order of the inputs.
+        """
+        assert len(transformed_images) == len(
+            original_image_sizes
+        ), "encode_torch_images needs one original size per image."
+        for image in transformed_images:
+            assert (
+                len(image.shape) == 3
+                and image.shape[0] == 3
+                and max(*image.shape[1:]) == self.model.image_encoder.img_size
+            ), f"encode_torch_images inputs must be CHW with long side {self.model.image_encoder.img_size}."
+
+        input_images = torch.stack([self.model.preprocess(x) for x in transformed_images], dim=0)
+        features = self.model.image_encoder(input_images)
+
+        # Clone each slice so keeping one embedding does not keep the whole batch alive
+        return [
+            ImageEmbedding(
+                features[i : i + 1].clone(),
+                tuple(original_size),
+                tuple(image.shape[-2:]),
+            )
+            for i, (image, original_size) in enumerate(zip(transformed_images, original_image_sizes))
+        ]
+
+    def set_embedding(
+        self,
+        features: torch.Tensor,
+        original_image_size: Tuple[int, ...],
+        input_size: Tuple[int, ...],
+    ) -> None:
+        """
+        Sets precomputed image embeddings, e.g. restored from a cache or
+        returned by 'encode_images', allowing masks to be predicted with the
+        'predict' method without running the image encoder.
+
+        Arguments:
+          features (torch.Tensor): The image embeddings with shape 1xCxHxW,
+            as returned by 'get_image_embedding'.
+          original_image_size (tuple(int, int)): The size of the image
+            before transformation, in (H, W) format.
+          input_size (tuple(int, int)): The size of the image after
+            ResizeLongestSide, in (H, W) format.
+        """
+        assert (
+            len(features.shape) == 4 and features.shape[0] == 1
+        ), "set_embedding input must have shape 1xCxHxW."
+        self.reset_image()
+
+        self.original_size = tuple(original_image_size)
+        self.input_size = tuple(input_size)
+        self.features = features.to(self.device)
+        self.is_image_set = True
+
     def predict(
         self,
         point_coords: Optional[np.ndarray] = None,
@@ -133,23 +254,9 @@ class SamPredictor:
         if not self.is_image_set:
             raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
 
-        # Transform input prompts
-        coords_torch, labels_torch, box_torch, mask_input_torch = None, None, None, None
-        if point_coords is not None:
-            assert (
-                point_labels is not None
-            ), "point_labels must be supplied if point_coords is supplied."
-            point_coords = self.transform.apply_coords(point_coords, self.original_size)
-            coords_torch = torch.as_tensor(point_coords, dtype=torch.float, device=self.device)
-            labels_torch = torch.as_tensor(point_labels, dtype=torch.int, device=self.device)
-            coords_torch, labels_torch = coords_torch[None, :, :], labels_torch[None, :]
-        if box is not None:
-            box = self.transform.apply_boxes(box, self.original_size)
-            box_torch = torch.as_tensor(box, dtype=torch.float, device=self.device)
-            box_torch = box_torch[None, :]
-        if mask_input is not None:
-            mask_input_torch = torch.as_tensor(mask_input, dtype=torch.float, device=self.device)
-            mask_input_torch = mask_input_torch[None, :, :, :]
+        coords_torch, labels_torch, box_torch, mask_input_torch = self._transform_prompts(
+            point_coords, point_labels, box, mask_input
+        )
 
         masks, iou_predictions, low_res_masks = self.predict_torch(
             coords_torch,
@@ -213,6 +320,167 @@ class SamPredictor:
         if not self.is_image_set:
             raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
 
+        low_res_masks, iou_predictions = self._decode_masks(
+            point_coords, point_labels, boxes, mask_input, multimask_output
+        )
+
+        # Upscale the masks to the original image resolution
+        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+
+        if not return_logits:
+            masks = masks > self.model.mask_threshold
+
+        return masks, iou_predictions, low_res_masks
+
+    @torch.no_grad()
+    def predict_low_res_torch(
+        self,
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor] = None,
+        mask_input: Optional[torch.Tensor] = None,
+        multimask_output: bool = True,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Like 'predict_torch', but the masks are not upscaled to the original
+        image size. Returns the low resolution logits in BxCxHxW format, where
+        H=W=256, and the predicted IoUs in BxC format.
+        """
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        return self._decode_masks(point_coords, point_labels, boxes, mask_input, multimask_output)
+
+    def predict_boxes(
+        self,
+        point_coords: Optional[np.ndarray] = None,
+        point_labels: Optional[np.ndarray] = None,
+        box: Optional[np.ndarray] = None,
+        mask_input: Optional[np.ndarray] = None,
+        multimask_output: bool = True,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Predict only the boxes around the masks for the given input prompts,
+        using the currently set image. The masks are never upscaled to the
+        original image size: the box is found on the mask at the model's input
+        resolution and its coordinates are scaled to the original image, so
+        the box edges are accurate to one input pixel (original size / input
+        size pixels of the original image).
+
+        Arguments are the same as for 'predict'.
+
+        Returns:
+          (np.ndarray): The boxes in Cx4 format, where C is the number of
+            masks, in XYXY format with inclusive max coordinates of the
+            original image. An empty mask gives [0, 0, 0, 0].
+          (np.ndarray): An array of length C containing the model's
+            predictions for the quality of each mask.
+          (np.ndarray): An array of shape CxHxW, where C is the number
+            of masks and H=W=256. These low resolution logits can be passed to
+            a subsequent iteration as mask input.
+        """
+        masks, iou_predictions, low_res_masks = self.predict_input_masks(
+            point_coords, point_labels, box, mask_input, multimask_output
+        )
+
+        boxes = batched_mask_to_box(torch.as_tensor(masks)).numpy()
+        empty = ~masks.any(axis=(-2, -1))
+        boxes = self.input_boxes_to_original(boxes)
+        boxes[empty] = 0
+        return boxes, iou_predictions, low_res_masks
+
+    def predict_input_masks(
+        self,
+        point_coords: Optional[np.ndarray] = None,
+        point_labels: Optional[np.ndarray] = None,
+        box: Optional[np.ndarray] = None,
+        mask_input: Optional[np.ndarray] = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Like 'predict', but the masks are returned at the resolution of the
+        model input (input_size, without the padding) instead of the original
+        image size. Boxes found on them are mapped to the original image with
+        'input_boxes_to_original'.
+        """
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        coords_torch, labels_torch, box_torch, mask_input_torch = self._transform_prompts(
+            point_coords, point_labels, box, mask_input
+        )
+
+        with torch.no_grad():
+            low_res_masks, iou_predictions = self._decode_masks(
+                coords_torch, labels_torch, box_torch, mask_input_torch, multimask_output
+            )
+            img_size = self.model.image_encoder.img_size
+            masks = F.interpolate(low_res_masks, (img_size, img_size), mode="bilinear", align_corners=False)
+            masks = masks[..., : self.input_size[0], : self.input_size[1]]
+
+            if not return_logits:
+                masks = masks > self.model.mask_threshold
+
+        masks_np = masks[0].detach().cpu().numpy()
+        iou_predictions_np = iou_predictions[0].detach().cpu().numpy()
+        low_res_masks_np = low_res_masks[0].detach().cpu().numpy()
+        return masks_np, iou_predictions_np, low_res_masks_np
+
+    def input_boxes_to_original(self, boxes: np.ndarray) -> np.ndarray:
+        """
+        Maps boxes in XYXY format with inclusive max coordinates from the
+        model input frame to the original image. The box covers every
+        original pixel that the input pixels of the box upscale to.
+        """
+        assert self.original_size is not None and self.input_size is not None, "An image must be set."
+        scale_y = self.original_size[0] / self.input_size[0]
+        scale_x = self.original_size[1] / self.input_size[1]
+        boxes = np.asarray(boxes, dtype=np.float64)
+
+        out = np.empty(boxes.shape, dtype=np.int64)
+        out[..., 0] = np.floor(boxes[..., 0] * scale_x)
+        out[..., 1] = np.floor(boxes[..., 1] * scale_y)
+        out[..., 2] = np.ceil((boxes[..., 2] + 1) * scale_x) - 1
+        out[..., 3] = np.ceil((boxes[..., 3] + 1) * scale_y) - 1
+        out[..., 0::2] = out[..., 0::2].clip(0, self.original_size[1] - 1)
+        out[..., 1::2] = out[..., 1::2].clip(0, self.original_size[0] - 1)
+        return out
+
+    def _transform_prompts(
+        self,
+        point_coords: Optional[np.ndarray],
+        point_labels: Optional[np.ndarray],
+        box: Optional[np.ndarray],
+        mask_input: Optional[np.ndarray],
+    ) -> Tuple[Optional[torch.Tensor], ...]:
+        # Transform input prompts
+        coords_torch, labels_torch, box_torch, mask_input_torch = None, None, None, None
+        if point_coords is not None:
+            assert (
+                point_labels is not None
+            ), "point_labels must be supplied if point_coords is supplied."
+            point_coords = self.transform.apply_coords(point_coords, self.original_size)
+            coords_torch = torch.as_tensor(point_coords, dtype=torch.float, device=self.device)
+            labels_torch = torch.as_tensor(point_labels, dtype=torch.int, device=self.device)
+            coords_torch, labels_torch = coords_torch[None, :, :], labels_torch[None, :]
+        if box is not None:
+            box = self.transform.apply_boxes(box, self.original_size)
+            box_torch = torch.as_tensor(box, dtype=torch.float, device=self.device)
+            box_torch = box_torch[None, :]
+        if mask_input is not None:
+            mask_input_torch = torch.as_tensor(mask_input, dtype=torch.float, device=self.device)
+            mask_input_torch = mask_input_torch[None, :, :, :]
+        return coords_torch, labels_torch, box_torch, mask_input_torch
+
+    def _decode_masks(
+        self,
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor],
+        mask_input: Optional[torch.Tensor],
+        multimask_output: bool,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
         if point_coords is not None:
             points = (point_coords, point_labels)
         else:
@@ -233,14 +501,9 @@ class SamPredictor:
             dense_prompt_embeddings=dense_embeddings,
             multimask_output=multimask_output,
         )
-
-        # Upscale the masks to the original image resolution
-        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
-
-        if not return_logits:
-            masks = masks > self.model.mask_threshold
-
-        return masks, iou_predictions, low_res_masks
+        # Under bfloat16 autocast the decoder outputs are bfloat16, which
+        # numpy cannot represent, the rest is done in float32
+        return low_res_masks.float(), iou_predictions.float()
 
     def get_image_embedding(self) -> torch.Tensor:
         """
@@ -10,7 +10,7 @@ import torch
 import math
 from copy import deepcopy
 from itertools import product
-from typing import Any, Dict, Generator, ItemsView, List, Tuple
+from typing import Any, Dict, Generator, ItemsView, List, Optional, Tuple
 
 
 class MaskData:
@@ -22,14 +22,14 @@ class MaskData:
     def __init__(self, **kwargs) -> None:
         for v in kwargs.values():
             assert isinstance(
-                v, (list, np.ndarray, torch.Tensor)
-            ), "MaskData only supports list, numpy arrays, and torch tensors."
+                v, (list, np.ndarray, torch.Tensor, CroppedMasks)
+            ), "MaskData only supports list, numpy arrays, torch tensors, and CroppedMasks."
         self._stats = dict(**kwargs)
 
     def __setitem__(self, key: str, item: Any) -> None:
         assert isinstance(
-            item, (list, np.ndarray, torch.Tensor)
-        ), "MaskData only supports list, numpy arrays, and torch tensors."
+            item, (list, np.ndarray, torch.Tensor, CroppedMasks)
+        ), "MaskData only supports list, numpy arrays, torch tensors, and CroppedMasks."
         self._stats[key] = item
 
     def __delitem__(self, key: str) -> None:
@@ -53,12 +53,17 @@ class MaskData:
                 self._stats[k] = [a for i, a in enumerate(v) if keep[i]]
             elif isinstance(v, list):
                 self._stats[k] = [v[i] for i in keep]
+            elif isinstance(v, CroppedMasks):
+                self._stats[k] = v[keep]
             else:
                 raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
 
     def cat(self, new_stats: "MaskData") -> None:
         for k, v in new_stats.items():
-            if k not in self._stats or self._stats[k] is None:
+            if isinstance(v, CroppedMasks):
+                # The crops are never modified in place, so they are shared instead of copied
+                self._stats[k] = v if self._stats.get(k) is None else self._stats[k].cat(v)
+            elif k not in self._stats or self._stats[k] is None:
                 self._stats[k] = deepcopy(v)
             elif isinstance(v, torch.Tensor):
                 self._stats[k] = torch.cat([self._stats[k], v], dim=0)
@@ -75,6 +80,286 @@ class MaskData:
                 self._stats[k] = v.detach().cpu().numpy()
 
 
+class CroppedMasks:
+    """
+    Binary masks of one image, each stored cropped to its bounding box
+    together with the position of the crop in the image, packed to one bit
+    per pixel. Memory scales with the area of the objects instead of the
+    area of the image. Supports the indexing used by MaskData.filter,
+    concatenation, boxes for NMS and RLE encoding without expanding the
+    masks to the image size.
+    """
+
+    def __init__(
+        self, crops: List[np.ndarray], offsets: np.ndarray, image_size: Tuple[int, int]
+    ) -> None:
+        assert len(crops) == len(offsets), "Every crop needs an offset."
+        self.packed = [np.packbits(crop, axis=None) for crop in crops]
+        self.shapes = np.array([crop.shape for crop in crops], dtype=np.int64).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)  # XY of each crop
+        self.image_size = tuple(image_size)
+
+    @classmethod
+    def _from_packed(
+        cls,
+        packed: List[np.ndarray],
+        shapes: np.ndarray,
+        offsets: np.ndarray,
+        image_size: Tuple[int, int],
+    ) -> "CroppedMasks":
+        masks = cls.__new__(cls)
+        masks.packed, masks.shapes, masks.offsets, masks.image_size = packed, shapes, offsets, image_size
+        return masks
+
+    @classmethod
+    def from_masks(
+        cls,
+        masks: torch.Tensor,
+        boxes: torch.Tensor,
+        crop_box: List[int],
+        image_size: Tuple[int, int],
+    ) -> "CroppedMasks":
+        """
+        Crops a batch of masks in BxHxW format to their boxes, given in XYXY
+        format as returned by batched_mask_to_box. The masks are in the frame
+        of crop_box, the offsets are in the frame of the whole image.
+        """
+        x0, y0 = crop_box[0], crop_box[1]
+        boxes_np = boxes.detach().cpu().numpy()
+        crops = []
+        for mask, (bx0, by0, bx1, by1) in zip(masks, boxes_np):
+            crops.append(mask[by0 : by1 + 1, bx0 : bx1 + 1].detach().cpu().numpy())
+        offsets = boxes_np[:, :2] + np.array([x0, y0])
+        return cls(crops, offsets, image_size)
+
+    def __len__(self) -> int:
+        return len(self.packed)
+
+    def __getitem__(self, keep: Any) -> "CroppedMasks":
+        if isinstance(keep, torch.Tensor):
+            keep = keep.detach().cpu().numpy()
+        keep = np.asarray(keep)
+        if keep.dtype == bool:
+            keep = np.flatnonzero(keep)
+        return CroppedMasks._from_packed(
+            [self.packed[i] for i in keep], self.shapes[keep], self.offsets[keep], self.image_size
+        )
+
+    def cat(self, other: "CroppedMasks") -> "CroppedMasks":
+        assert self.image_size == other.image_size, "Masks must belong to the same image."
+        shapes = np.concatenate([self.shapes, other.shapes], axis=0)
+        offsets = np.concatenate([self.offsets, other.offsets], axis=0)
+        return CroppedMasks._from_packed(self.packed + other.packed, shapes, offsets, self.image_size)
+
+    def crop(self, i: int) -> np.ndarray:
+        """The i-th mask, cropped to its box, in HW format."""
+        h, w = self.shapes[i]
+        return np.unpackbits(self.packed[i], count=h * w).reshape(h, w).view(bool)
+
+    def boxes(self) -> torch.Tensor:
+        """Boxes in XYXY format around the masks, [0,0,0,0] for an empty mask."""
+        boxes = torch.zeros(len(self), 4, dtype=torch.long)
+        for i, (x0, y0) in enumerate(self.offsets):
+            crop = self.crop(i)
+            box = batched_mask_to_box(torch.as_tensor(crop))
+            if crop.any():
+                boxes[i] = box + torch.tensor([x0, y0, x0, y0])
+        return boxes
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        """Whether any of the masks contains each point, given in XY format in the image frame."""
+        xy = np.floor(points).astype(np.int64)
+        inside = np.zeros(len(xy), dtype=bool)
+        for packed, (h, w), (x0, y0) in zip(self.packed, self.shapes, self.offsets):
+            col, row = xy[:, 0] - x0, xy[:, 1] - y0
+            in_box = (col >= 0) & (row >= 0) & (col < w) & (row < h)
+            idx = np.flatnonzero(in_box & ~inside)
+            bit = row[idx] * w + col[idx]
+            inside[idx] = (packed[bit >> 3] >> (7 - (bit & 7))) & 1  # read the bits in place
+        return inside
+
+    def areas(self) -> np.ndarray:
+        return np.array([int(np.unpackbits(packed).sum()) for packed in self.packed], dtype=np.int64)
+
+    def to_mask(self, i: int) -> np.ndarray:
+        mask = np.zeros(self.image_size, dtype=bool)
+        (x0, y0), (h, w) = self.offsets[i], self.shapes[i]
+        mask[y0 : y0 + h, x0 : x0 + w] = self.crop(i)
+        return mask
+
+    def to_rle(self) -> List[Dict[str, Any]]:
+        """Same output as mask_to_rle_pytorch on the masks expanded to the image size."""
+        return [self._crop_to_rle(self.crop(i), x0, y0) for i, (x0, y0) in enumerate(self.offsets)]
+
+    def _crop_to_rle(self, crop: np.ndarray, x0: int, y0: int) -> Dict[str, Any]:
+        h, w = self.image_size
+        ch, cw = crop.shape
+        if ch == 0 or cw == 0:
+            return {"size": [h, w], "counts": [h * w]}
+
+        # Pad each column with a zero above and below, standing for the
+        # background between the columns of the crop, and find the changes
+        # in fortran order like mask_to_rle_pytorch
+        padded = np.zeros((cw, ch + 2), dtype=bool)
+        padded[:, 1:-1] = crop.T
+        flat = padded.ravel()
+        change = np.flatnonzero(flat[1:] ^ flat[:-1]) + 1
+
+        # Position in the image of the element each run starts at
+        col, row = np.divmod(change, ch + 2)
+        starts = (x0 + col) * h + y0 + row - 1
+
+        # A padding zero that stands for an empty gap (the crop spans the
+        # whole height, or touches the end of the image) gives a run of
+        # length zero, drop those changes in pairs and at the end
+        starts = starts[starts < h * w]
+        repeated = np.zeros(len(starts), dtype=bool)
+        same = starts[1:] == starts[:-1]
+        repeated[1:] |= same
+        repeated[:-1] |= same
+        if starts.size and starts[0] == 0:
+            repeated[0] = False  # the mask starts with a one, the counts start with 0
+        starts = starts[~repeated]
+
+        counts = np.diff(np.concatenate([[0], starts, [h * w]]))
+        return {"size": [h, w], "counts": counts.tolist()}
+
+
+def linear_resize_indices(
+    in_size: int, out_size: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Source indices and weights of a bilinear resize along one axis with
+    align_corners=False, as computed by torch.nn.functional.interpolate.
+    Output pixel i is w0[i] * x[i0[i]] + w1[i] * x[i1[i]].
+    """
+    scale = np.float32(in_size) / np.float32(out_size)
+    src = scale * (np.arange(out_size, dtype=np.float32) + np.float32(0.5)) - np.float32(0.5)
+    src = np.maximum(src, 0)
+    i0 = np.floor(src).astype(np.int64)
+    i1 = np.minimum(i0 + 1, in_size - 1)
+    w1 = np.clip(src - i0, 0, 1).astype(np.float32)
+    return i0, i1, 1 - w1, w1
+
+
+class _AxisUpscale:
+    # The two resizes of Sam.postprocess_masks along one axis: low resolution
+    # to the padded model input, then the unpadded input to the original size
+    def __init__(self, low_res_size: int, img_size: int, input_size: int, original_size: int) -> None:
+        self.first = [a[:input_size] for a in linear_resize_indices(low_res_size, img_size)]
+        self.second = linear_resize_indices(input_size, original_size)
+
+    def window(self, low0: int, low1: int) -> Tuple[int, int]:
+        """Range of original pixels that depend on the low resolution pixels low0..low1, inclusive."""
+        k0 = int(np.searchsorted(self.first[1], low0, side="left"))
+        k1 = int(np.searchsorted(self.first[0], low1, side="right")) - 1
+        i0 = int(np.searchsorted(self.second[1], k0, side="left"))
+        i1 = int(np.searchsorted(self.second[0], k1, side="right")) - 1
+        return i0, i1
+
+    def sources(self, i0: int, i1: int) -> Tuple[int, int]:
+        """Range of low resolution pixels the original pixels i0..i1 depend on."""
+        return int(self.first[0][self.second[0][i0]]), int(self.first[1][self.second[1][i1]])
+
+    def upscale(self, x: torch.Tensor, i0: int, i1: int) -> torch.Tensor:
+        """Resizes the last axis of x, low resolution pixels from sources(i0, i1), to the original pixels i0..i1."""
+        second = [a[i0 : i1 + 1] for a in self.second]
+        k0, k1 = int(second[0][0]), int(second[1][-1])
+        first = [a[k0 : k1 + 1] for a in self.first]
+        x = self._resize(x, *first, start=int(first[0][0]))
+        return self._resize(x, *second, start=k0)
+
+    @staticmethod
+    def _resize(x, i0, i1, w0, w1, start) -> torch.Tensor:
+        i0 = torch.as_tensor(i0 - start, device=x.device)
+        i1 = torch.as_tensor(i1 - start, device=x.device)
+        w0 = torch.as_tensor(w0, device=x.device)
+        w1 = torch.as_tensor(w1, device=x.device)
+        return x[..., i0] * w0 + x[..., i1] * w1
+
+
+class MaskUpscaler:
+    """
+    Upscales low resolution mask logits to the original image size like
+    Sam.postprocess_masks, but each mask only inside the window of pixels
+    that can exceed a threshold: a bilinear resize never exceeds the largest
+    of its source pixels. The values match postprocess_masks up to floating
+    point rounding.
+    """
+
+    def __init__(
+        self,
+        img_size: int,
+        input_size: Tuple[int, ...],
+        original_size: Tuple[int, ...],
+        low_res_size: int = 256,
+    ) -> None:
+        self.rows = _AxisUpscale(low_res_size, img_size, input_size[0], original_size[0])
+        self.cols = _AxisUpscale(low_res_size, img_size, input_size[1], original_size[1])
+
+    def upscale_window(
+        self, logits: torch.Tensor, threshold: float
+    ) -> Optional[Tuple[int, int, torch.Tensor]]:
+        """
+        Upscales one HxW mask inside the window of original pixels that can
+        exceed threshold. Returns the XY position of the window and its
+        logits, or None if no pixel can.
+        """
+        # Pixels at the threshold count too, rounding can lift their neighbours above it
+        above = logits >= threshold
+        rows, cols = above.any(1).nonzero()[:, 0], above.any(0).nonzero()[:, 0]
+        if len(rows) == 0:
+            return None
+        y0, y1 = self.rows.window(int(rows[0]), int(rows[-1]))
+        x0, x1 = self.cols.window(int(cols[0]), int(cols[-1]))
+        if y0 > y1 or x0 > x1:
+            return None  # only the padding exceeds the threshold
+
+        low_y0, low_y1 = self.rows.sources(y0, y1)
+        low_x0, low_x1 = self.cols.sources(x0, x1)
+        window = logits[low_y0 : low_y1 + 1, low_x0 : low_x1 + 1]
+        window = self.cols.upscale(window, x0, x1)
+        window = self.rows.upscale(window.T, y0, y1).T
+        return x0, y0, window
+
+    def crop_masks(
+        self, low_res_masks: torch.Tensor, mask_threshold: float, threshold_offset: float
+    ) -> Tuple[List[np.ndarray], torch.Tensor, torch.Tensor]:
+        """
+        Thresholds a batch of low resolution logits in BxHxW format at the
+        original size, without expanding them to it.
+
+        Returns:
+          (list(np.ndarray)): The binary masks, cropped to their boxes.
+          (torch.Tensor): The boxes in XYXY format, as batched_mask_to_box.
+          (torch.Tensor): The stability scores, as calculate_stability_score.
+        """
+        crops = []
+        boxes = torch.zeros(len(low_res_masks), 4, dtype=torch.long)
+        intersections = torch.zeros(len(low_res_masks), dtype=torch.int32)
+        unions = torch.zeros(len(low_res_masks), dtype=torch.int32)
+        for i, logits in enumerate(low_res_masks):
+            window = self.upscale_window(logits, mask_threshold - threshold_offset)
+            if window is None:
+                crops.append(np.zeros((1, 1), dtype=bool))  # empty masks keep a single pixel crop
+                continue
+            x0, y0, window = window
+            intersections[i] = int((window > (mask_threshold + threshold_offset)).sum())
+            unions[i] = int((window > (mask_threshold - threshold_offset)).sum())
+
+            mask = window > mask_threshold
+            rows, cols = mask.any(1).nonzero()[:, 0], mask.any(0).nonzero()[:, 0]
+            if len(rows) == 0:
+                crops.append(np.zeros((1, 1), dtype=bool))
+                continue
+            r0, r1, c0, c1 = int(rows[0]), int(rows[-1]), int(cols[0]), int(cols[-1])
+            crops.append(mask[r0 : r1 + 1, c0 : c1 + 1].cpu().numpy())
+            boxes[i] = torch.tensor([x0 + c0, y0 + r0, x0 + c1, y0 + r1])
+
+        device = low_res_masks.device
+        return crops, boxes.to(device), (intersections / unions).to(device)
+
+
 def is_box_near_crop_edge(
     boxes: torch.Tensor, crop_box: List[int], orig_box: List[int], atol: float = 20.0
 ) -> torch.Tensor:
@@ -113,24 +398,36 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     b, h, w = tensor.shape
     tensor = tensor.permute(0, 2, 1).flatten(1)
 
-    # Compute change indices
+    # Compute change indices, sorted by mask and then by position
     diff = tensor[:, 1:] ^ tensor[:, :-1]
-    change_indices = diff.nonzero()
-
-    # Encode run length
-    out = []
-    for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
+    change_indices = diff.nonzero().cpu().numpy()
+    first_values = tensor[:, 0].cpu().numpy()
+    return _changes_to_rle(change_indices[:, 0], change_indices[:, 1] + 1, first_values, b, h, w)
+
+
+def _changes_to_rle(
+    mask_ids: np.ndarray, starts: np.ndarray, first_values: np.ndarray, b: int, h: int, w: int
+) -> List[Dict[str, Any]]:
+    # Run lengths for all masks at once: the distance to the previous change
+    # of the same mask, or to the start of the mask for its first change
+    prev = np.zeros_like(starts)
+    prev[1:] = starts[:-1]
+    first_change = np.ones(len(starts), dtype=bool)
+    first_change[1:] = mask_ids[1:] != mask_ids[:-1]
+    prev[first_change] = 0
+    runs = starts - prev
+
+    # Split once by mask, the last run of each mask ends at h * w
+    n_changes = np.bincount(mask_ids, minlength=b)
+    ends = np.cumsum(n_changes)
+    last_starts = np.zeros(b, dtype=np.int64)
+    last_starts[n_changes > 0] = starts[ends[n_changes > 0] - 1]
+
+    out: List[Dict[str, Any]] = []
+    for i, mask_runs in enumerate(np.split(runs, ends[:-1]) if b > 0 else []):
+        counts = [] if first_values[i] == 0 else [0]
+        counts.extend(mask_runs.tolist())
+        counts.append(int(h * w - last_starts[i]))
         out.append({"size": [h, w], "counts": counts})
     return out
 
@@ -138,13 +435,9 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
     h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    parity = np.arange(len(counts)) % 2 == 1
+    mask = np.repeat(parity, counts)
     mask = mask.reshape(w, h)
     return mask.transpose()  # Put in C order
 
@@ -186,6 +479,21 @@ def build_point_grid(n_per_side: int) -> np.ndarray:
     return points
 
 
+def coarse_to_fine_order(points: np.ndarray) -> np.ndarray:
+    """
+    Orders the points of a grid from coarse to fine: every other point along
+    both axes comes before the points in between, recursively. Points are
+    ranked by their position among the distinct coordinates on each axis,
+    so irregular grids get a comparable order. Returns indices into points.
+    """
+    ranks = [np.unique(points[:, axis], return_inverse=True)[1].reshape(-1) for axis in range(2)]
+    # The lowest set bit of the combined ranks is the finest level the point
+    # is on, the first point of each axis belongs to all levels
+    combined = np.bitwise_or(ranks[0], ranks[1]).astype(np.int64)
+    lowest_bit = np.where(combined == 0, np.iinfo(np.int64).max, combined & -combined)
+    return np.argsort(-lowest_bit, kind="stable")
+
+
 def build_all_layer_point_grids(
     n_per_side: int, n_layers: int, scale_per_layer: int
 ) -> List[np.ndarray]:
@@ -291,6 +599,57 @@ def remove_small_regions(
     return mask, True
 
 
+def remove_small_regions_cropped(
+    mask: np.ndarray,
+    area_thresh: float,
+    mode: str,
+    offset: Tuple[int, int],
+    image_size: Tuple[int, ...],
+) -> Tuple[np.ndarray, Tuple[int, int], bool]:
+    """
+    Same as remove_small_regions on the full image, for a mask cropped out
+    of it at offset (x, y) and empty outside the crop. Returns the result
+    with its offset, which is only moved if a filled hole reaches outside
+    the crop.
+    """
+    import cv2  # type: ignore
+
+    if mode == "islands" or mask.size == 0:
+        # Islands lie inside the crop
+        if mask.size == 0:
+            return mask, offset, False
+        mask, changed = remove_small_regions(mask, area_thresh, mode)
+        return mask, offset, changed
+
+    # The background around the crop is collapsed into one row or column per
+    # side, weighted by the number of image rows or columns it stands for
+    h, w = mask.shape
+    x0, y0 = int(offset[0]), int(offset[1])
+    row_weights = np.array([y0] + [1] * h + [image_size[0] - y0 - h])
+    col_weights = np.array([x0] + [1] * w + [image_size[1] - x0 - w])
+    rows, cols = row_weights > 0, col_weights > 0
+    padded = np.pad(mask, 1)[rows][:, cols]
+
+    working_mask = (~padded).astype(np.uint8)
+    n_labels, regions, _, _ = cv2.connectedComponentsWithStats(working_mask, 8)
+    weights = np.outer(row_weights[rows], col_weights[cols])
+    sizes = np.bincount(regions.ravel(), weights=weights.ravel(), minlength=n_labels)
+    small_regions = [i for i in range(1, n_labels) if sizes[i] < area_thresh]
+    if len(small_regions) == 0:
+        return mask, offset, False
+    filled = np.isin(regions, [0] + small_regions)
+    top, left = int(rows[0]), int(cols[0])
+    inner = filled[top : top + h, left : left + w]
+    if filled.sum() > inner.sum():
+        # A small hole outside the crop, only when the mask (nearly) spans
+        # the image, is filled on the full image
+        full_mask = np.zeros(image_size[:2], dtype=bool)
+        full_mask[y0 : y0 + h, x0 : x0 + w] = mask
+        full_mask, _ = remove_small_regions(full_mask, area_thresh, mode)
+        return full_mask, (0, 0), True
+    return inner, offset, True
+
+
 def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
     from pycocotools import mask as mask_utils  # type: ignore
 
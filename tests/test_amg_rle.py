@@ -0,0 +1,116 @@
+from typing import Any, Dict, List
+
+import numpy as np
+import pytest
+import torch
+
+from segment_anything.utils.amg import CroppedMasks, batched_mask_to_box, mask_to_rle_pytorch, rle_to_mask
+
+
+# Reference implementations, as shipped with segment-anything
+def reference_mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
+    b, h, w = tensor.shape
+    tensor = tensor.permute(0, 2, 1).flatten(1)
+
+    diff = tensor[:, 1:] ^ tensor[:, :-1]
+    change_indices = diff.nonzero()
+
+    out = []
+    for i in range(b):
+        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
+        cur_idxs = torch.cat(
+            [
+                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
+                cur_idxs + 1,
+                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
+            ]
+        )
+        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
+        counts = [] if tensor[i, 0] == 0 else [0]
+        counts.extend(btw_idxs.detach().cpu().tolist())
+        out.append({"size": [h, w], "counts": counts})
+    return out
+
+
+def reference_rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
+    h, w = rle["size"]
+    mask = np.empty(h * w, dtype=bool)
+    idx = 0
+    parity = False
+    for count in rle["counts"]:
+        mask[idx : idx + count] = parity
+        idx += count
+        parity ^= True
+    mask = mask.reshape(w, h)
+    return mask.transpose()
+
+
+def random_masks(b, h, w, density, seed=0):
+    return torch.from_numpy(np.random.RandomState(seed).rand(b, h, w) < density)
+
+
+def single_pixel_masks(h, w):
+    # one pixel at each corner, on the edges and inside
+    points = [(0, 0), (0, w - 1), (h - 1, 0), (h - 1, w - 1), (h // 2, w // 2), (0, w // 2), (h // 2, 0)]
+    masks = torch.zeros(len(points), h, w, dtype=torch.bool)
+    for i, (y, x) in enumerate(points):
+        masks[i, y, x] = True
+    return masks
+
+
+def blob_masks(h, w, seed=0):
+    # rectangles, including ones spanning the whole height or width
+    rng = np.random.RandomState(seed)
+    masks = torch.zeros(12, h, w, dtype=torch.bool)
+    for i in range(len(masks) - 2):
+        y0, x0 = rng.randint(0, h), rng.randint(0, w)
+        y1, x1 = rng.randint(y0, h) + 1, rng.randint(x0, w) + 1
+        masks[i, y0:y1, x0:x1] = True
+    masks[-2, :, w // 3 : w // 2 + 1] = True
+    masks[-1, h // 3 : h // 2 + 1, :] = True
+    return masks
+
+
+CASES = {
+    "random": random_masks(6, 37, 53, 0.5),
+    "sparse": random_masks(6, 37, 53, 0.02),
+    "dense": random_masks(6, 37, 53, 0.98),
+    "all_zero": torch.zeros(3, 37, 53, dtype=torch.bool),
+    "all_one": torch.ones(3, 37, 53, dtype=torch.bool),
+    "single_pixel": single_pixel_masks(37, 53),
+    "blobs": blob_masks(37, 53),
+    "odd_1xN": random_masks(4, 1, 9, 0.5),
+    "odd_Nx1": random_masks(4, 9, 1, 0.5),
+    "odd_1x1": torch.tensor([[[False]], [[True]]]),
+    "empty_batch": torch.zeros(0, 37, 53, dtype=torch.bool),
+}
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_mask_to_rle_matches_reference(name):
+    masks = CASES[name]
+    assert mask_to_rle_pytorch(masks) == reference_mask_to_rle_pytorch(masks)
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_rle_to_mask_matches_reference(name):
+    for rle, mask in zip(reference_mask_to_rle_pytorch(CASES[name]), CASES[name]):
+        decoded = rle_to_mask(rle)
+        np.testing.assert_array_equal(decoded, reference_rle_to_mask(rle))
+        np.testing.assert_array_equal(decoded, mask.numpy())
+
+
+@pytest.mark.parametrize("name", CASES)
+@pytest.mark.parametrize("offset", [(0, 0, 0), (5, 3, 2)])
+def test_cropped_masks_to_rle_matches_reference(name, offset):
+    # the masks of a crop layer at (x0, y0), with a margin to the end of the image
+    masks = CASES[name]
+    x0, y0, margin = offset
+    h, w = masks.shape[-2:]
+    crop_box = [x0, y0, x0 + w, y0 + h]
+    image_size = (y0 + h + margin, x0 + w + margin)
+
+    cropped = CroppedMasks.from_masks(masks, batched_mask_to_box(masks), crop_box, image_size)
+    expanded = torch.zeros(len(masks), *image_size, dtype=torch.bool)
+    expanded[:, y0 : y0 + h, x0 : x0 + w] = masks
+    assert cropped.to_rle() == reference_mask_to_rle_pytorch(expanded)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from segment_anything.utils.amg import CroppedMasks, MaskUpscaler, batched_mask_to_box, calculate_stability_score
+from segment_anything.utils.transforms import ResizeLongestSide
+
+
+def blob_logits(input_size, seed=0):
+    # round blobs with noisy edges inside the unpadded input, plus an empty and a full mask
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:256, 0:256]
+    logits = []
+    for _ in range(6):
+        cy, cx = rng.uniform(0, input_size[0] / 4), rng.uniform(0, input_size[1] / 4)
+        logits.append(rng.uniform(0, 40) - np.hypot(yy - cy, xx - cx) + rng.normal(0, 2, yy.shape))
+    logits += [np.full((256, 256), -5.0), np.full((256, 256), 5.0)]
+    return torch.tensor(np.array(logits), dtype=torch.float32)
+
+
+@pytest.mark.parametrize("original_size", [(300, 420), (1333, 777), (37, 1500)])
+def test_crop_masks_matches_postprocess_masks(original_size):
+    input_size = ResizeLongestSide.get_preprocess_shape(*original_size, 1024)
+    low_res_masks = blob_logits(input_size)
+
+    # Sam.postprocess_masks
+    masks = F.interpolate(low_res_masks[None], (1024, 1024), mode="bilinear", align_corners=False)
+    masks = masks[..., : input_size[0], : input_size[1]]
+    masks = F.interpolate(masks, original_size, mode="bilinear", align_corners=False)[0]
+
+    upscaler = MaskUpscaler(1024, input_size, original_size)
+    crops, boxes, stability_score = upscaler.crop_masks(low_res_masks, 0.0, 1.0)
+
+    assert boxes.tolist() == batched_mask_to_box(masks > 0).tolist()
+    torch.testing.assert_close(stability_score, calculate_stability_score(masks, 0.0, 1.0), equal_nan=True)
+    cropped = CroppedMasks(crops, boxes[:, :2].numpy(), original_size)
+    for i, mask in enumerate(masks > 0):
+        np.testing.assert_array_equal(cropped.to_mask(i), mask.numpy())
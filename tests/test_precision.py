@@ -0,0 +1,32 @@
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from segment_anything import sam_model_registry
+from utils.SAM import SA, PRECISIONS
+
+
+@pytest.fixture(scope="module")
+def image_path(tmp_path_factory):
+    image = np.zeros((96, 128, 3), dtype=np.uint8)
+    image[24:72, 32:96] = (200, 80, 40)
+    path = tmp_path_factory.mktemp("images") / "sample.png"
+    cv2.imwrite(str(path), image)
+    return str(path)
+
+
+@pytest.mark.parametrize("precision", PRECISIONS)
+def test_prompt_at_each_precision(precision, image_path):
+    # random weights, only the dtypes along the prompt path matter here
+    torch.manual_seed(0)
+    sam = SA(model_path="unused.pth", model=sam_model_registry["vit_b"](), gpu=False, precision=precision)
+
+    bbox = sam.predict_box(image_path, [[64, 48]], [1])
+    assert bbox is None or len(bbox) == 4
+
+    with sam.precision_context():
+        masks, scores, logits = sam.predictor.predict(point_coords=np.array([[64, 48]]), point_labels=np.array([1]))
+        boxes, _, _ = sam.predictor.predict_boxes(point_coords=np.array([[64, 48]]), point_labels=np.array([1]))
+    assert masks.shape == (3, 96, 128) and scores.dtype == np.float32 and logits.dtype == np.float32
+    assert boxes.shape == (3, 4)
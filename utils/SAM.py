@@ -1,59 +1,382 @@
+import os
+import queue
+import threading
+import contextlib
+from collections import OrderedDict
 import numpy as np
-import cv2
 import torch
-import numpy as np
-from typing import Tuple
+from typing import List, Optional, Tuple
 from segment_anything import SamPredictor, sam_model_registry
 
+from utils.embeddingCache import EmbeddingCache, checkpoint_id
+from utils.onnxDecoder import OnnxDecoder
+from utils.imageCache import read_rgb
+from utils.maskBox import mask_to_box, largest_component_box
+
+PRECISIONS = ["fp32", "int8", "bf16"]
+
 class SA():
-    def __init__(self, model_name="vit_b", model_path=None, gpu=True):
+    def __init__(self, model_name="vit_b", model_path=None, gpu=True, cache_dir=None, cache_bytes=2 * 1024**3, max_embeddings=4, model=None, background=False, on_loaded=None, precision="fp32", decoder="torch", onnx_dir="onnx", image_cache=None, tiled=False, window_size=1024, max_windows=8, largest_component=True):
         assert model_path is not None, "Missing \"model_path\" parameter!"
+        assert precision in PRECISIONS, f"\"precision\" must be one of {PRECISIONS}, got \"{precision}\"."
+        assert decoder in ["torch", "onnx"], f"\"decoder\" must be \"torch\" or \"onnx\", got \"{decoder}\"."
         self.model_name = model_name
         self.model_path = model_path
         self.gpu = gpu
+        self.precision = precision
+        self.decoder = decoder
+        self.largest_component = largest_component
+        self.onnx_dir = onnx_dir
+        self.onnx_decoder = None
+
+        self.sam = None
+        self.predictor = None
+        self.image_key = None       # (path, mtime) of the image embedded in predictor
+
+        # embeddings persisted across sessions, keyed by image content and checkpoint, opened by load()
+        self.cache = None
+        self.cache_dir = cache_dir
+        self.cache_bytes = cache_bytes
+
+        # decoded images shared with the viewer, so an image on screen is not decoded again for encoding
+        self.image_cache = image_cache
+
+        # tiled prompts: on images larger than window_size only the window around the points is encoded, at full resolution
+        self.tiled = tiled
+        self.window_size = window_size
+        self.window_predictor = None
+        self.window_embeddings = OrderedDict()     # (image key, window) -> embedding
+        self.max_windows = max_windows
 
-        self.sam = self.load_model(self.model_name, self.model_path)
+        # in-memory embeddings of the current and neighbouring images, filled by the prefetch thread
+        self.embeddings = OrderedDict()
+        self.max_embeddings = max_embeddings
+        self.embedding_lock = threading.Condition()
+        self.encoding_keys = set()          # images being encoded right now, by the GUI or the prefetch thread
+        self.prefetch_generation = 0        # bumped on every prefetch() call to cancel stale requests
+        self.prefetch_queue = queue.Queue(maxsize=3)
+        self.prefetch_thread = None
+
+        # loading the checkpoint takes seconds, with background=True it runs on a thread and on_loaded is called when done
+        self.ready = threading.Event()
+        self.load_error = None
+        self.on_loaded = on_loaded
+        if background:
+            threading.Thread(target=self.load, args=(model,), daemon=True).start()
+        else:
+            self.load(model)
 
     def device(self) -> None:
         return "cuda" if torch.cuda.is_available() and self.gpu else "cpu"
 
+    def load(self, model=None) -> None:
+        try:
+            # an already loaded model can be passed in, e.g. weights shared with a parent process
+            self.sam = model if model is not None else self.load_model(self.model_name, self.model_path)
+            if self.decoder == "onnx":
+                self.load_onnx_decoder()    # exported from the fp32 decoder, before apply_precision
+            self.sam = self.apply_precision(self.sam)
+            self.predictor = SamPredictor(self.sam)
+            self.window_predictor = SamPredictor(self.sam)
+            if self.cache_dir is not None:
+                model_id = f"{checkpoint_id(self.model_name, self.model_path)}:{self.precision}"
+                self.cache = EmbeddingCache(self.cache_dir, model_id, self.cache_bytes)
+        except Exception as e:
+            self.load_error = e
+            if not self.on_loaded:
+                raise
+        finally:
+            self.ready.set()
+
+        if self.on_loaded:
+            self.on_loaded()
+
+    def is_ready(self) -> bool:
+        return self.ready.is_set() and self.load_error is None
+
+    def wait_ready(self) -> None:
+        self.ready.wait()
+        if self.load_error is not None:
+            raise RuntimeError(f"Failed to load \"{self.model_path}\": {self.load_error}")
+
     def load_model(self, model_name: str, model_path: str):
         sam = sam_model_registry[model_name](checkpoint=model_path)
         sam.to(device=self.device())
 
         return sam
 
-    def get_bbox(self, mask: np.ndarray) -> Tuple[int, int, int, int]:
-        # flip the array vertically and convert to uint8 datatype
-        mask = np.uint8(mask * 255)
-        
-        # find the largest contour and its bounding rectangle
-        thresh = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)[1]
-        contours, hierarchy = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        max_contour = max(contours, key=cv2.contourArea)
-        x,y,w,h = cv2.boundingRect(max_contour)
+    def load_onnx_decoder(self) -> None:
+        if self.sam.device.type != "cpu":
+            print("The ONNX Runtime decoder runs on CPU only, using the PyTorch decoder.")
+            return
+
+        try:
+            self.onnx_decoder = OnnxDecoder(self.sam, self.onnx_dir, checkpoint_id(self.model_name, self.model_path))
+        except ImportError as e:
+            print(f"The ONNX Runtime decoder is unavailable ({e}), using the PyTorch decoder.")
+        except Exception as e:
+            # a failed export or session must not keep the model from loading
+            print(f"Failed to set up the ONNX Runtime decoder ({e!r}), using the PyTorch decoder.")
+
+    def apply_precision(self, sam):
+        if self.precision != "fp32" and sam.device.type != "cpu":
+            print(f"\"{self.precision}\" precision is only supported on CPU, using fp32.")
+            self.precision = "fp32"
+        if self.precision == "int8":
+            # weights of qkv, proj and MLP layers are stored in int8, activations are quantized on the fly
+            sam.image_encoder = torch.ao.quantization.quantize_dynamic(sam.image_encoder, {torch.nn.Linear}, dtype=torch.qint8)
+            sam.mask_decoder = torch.ao.quantization.quantize_dynamic(sam.mask_decoder, {torch.nn.Linear}, dtype=torch.qint8)
+
+        return sam
+
+    def precision_context(self):
+        if self.precision == "bf16":
+            return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def get_image_key(self, img_path: str) -> Tuple[str, float]:
+        return (img_path, os.path.getmtime(img_path))
+
+    def encode(self, predictor: SamPredictor, img_path: str) -> Tuple[torch.Tensor, Tuple[int, int], Tuple[int, int]]:
+        cache_key = self.cache.make_key(img_path) if self.cache is not None else None
+        cached = self.cache.get(cache_key) if self.cache is not None else None
+        if cached is not None:
+            features, original_size, input_size = cached
+            return torch.from_numpy(np.array(features)).to(predictor.device), original_size, input_size
+
+        image = self.read_image(img_path)
+        with self.precision_context():
+            predictor.set_image(image)
+        features = predictor.get_image_embedding().float()     # bf16 features are stored as fp32
+
+        if self.cache is not None:
+            self.cache.put(cache_key, features.detach().cpu().numpy(), predictor.original_size, predictor.input_size)
+
+        return features, predictor.original_size, predictor.input_size
+
+    def read_image(self, img_path: str) -> np.ndarray:
+        if self.image_cache is not None:
+            return self.image_cache.get(img_path).rgb
+        return read_rgb(img_path)
+
+    def store_embedding(self, image_key: Tuple[str, float], embedding: tuple) -> None:
+        # caller must hold self.embedding_lock
+        self.embeddings[image_key] = embedding
+        self.embeddings.move_to_end(image_key)
+        while len(self.embeddings) > self.max_embeddings:
+            self.embeddings.popitem(last=False)
+
+    def set_image(self, img_path: str) -> None:
+        self.wait_ready()
+
+        # the image encoder is only run when the image changes, prompts on the same image reuse the features
+        image_key = self.get_image_key(img_path)
+        if image_key == self.image_key:
+            return
+
+        with self.embedding_lock:
+            # keep the outgoing image around, it is the neighbour of the next one
+            if self.image_key is not None and self.predictor.is_image_set:
+                self.store_embedding(self.image_key, (self.predictor.features, self.predictor.original_size, self.predictor.input_size))
+            self.image_key = None
+
+            # the prefetch thread is already encoding this image, waiting is cheaper than encoding it twice
+            while image_key in self.encoding_keys:
+                self.embedding_lock.wait()
+            embedding = self.embeddings.get(image_key)
+            if embedding is None:
+                self.encoding_keys.add(image_key)   # a prefetch of this image is skipped meanwhile
 
-        return (x, y ,w ,h)
+        if embedding is None:
+            try:
+                embedding = self.encode(self.predictor, img_path)
+            finally:
+                with self.embedding_lock:
+                    self.encoding_keys.discard(image_key)
+                    self.embedding_lock.notify_all()
+        self.predictor.set_embedding(*embedding)
 
-    def predict_box(self, img_path: str, input_point_list: list, input_label_list: list) -> Tuple[int, int, int, int]:
-        image = cv2.imread(img_path)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        with self.embedding_lock:
+            self.image_key = image_key
 
+    def reset_image(self) -> None:
+        if self.predictor is not None:
+            self.predictor.reset_image()
+        self.image_key = None
+
+    def prefetch(self, img_paths: List[str]) -> None:
+        # replaces any pending requests, images already queued for an old position are dropped
+        if self.prefetch_thread is None:
+            self.prefetch_thread = threading.Thread(target=self.prefetch_worker, daemon=True)
+            self.prefetch_thread.start()
+
+        with self.embedding_lock:
+            self.prefetch_generation += 1
+            generation = self.prefetch_generation
+
+        while True:
+            try:
+                self.prefetch_queue.get_nowait()
+            except queue.Empty:
+                break
+
+        for img_path in img_paths:
+            try:
+                self.prefetch_queue.put_nowait((generation, img_path))
+            except queue.Full:
+                break
+
+    def prefetch_worker(self) -> None:
+        self.ready.wait()
+        if self.load_error is not None:
+            return
+        predictor = SamPredictor(self.sam)      # own predictor state, shares the model weights
+
+        while True:
+            generation, img_path = self.prefetch_queue.get()
+
+            with self.embedding_lock:
+                if generation != self.prefetch_generation:
+                    continue
+                try:
+                    image_key = self.get_image_key(img_path)
+                except OSError:
+                    continue
+                if image_key == self.image_key or image_key in self.embeddings or image_key in self.encoding_keys:
+                    continue
+                self.encoding_keys.add(image_key)
+
+            embedding = None
+            try:
+                embedding = self.encode(predictor, img_path)
+            except Exception as e:
+                print(f"Prefetching \"{img_path}\" failed: {e}")
+            finally:
+                predictor.reset_image()
+
+                with self.embedding_lock:
+                    self.encoding_keys.discard(image_key)
+                    if embedding is not None:
+                        self.store_embedding(image_key, embedding)
+                    self.embedding_lock.notify_all()
+
+    def get_bbox(self, mask: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+        # None for an empty mask, stray islands of the mask are dropped with largest_component
+        if self.largest_component:
+            return largest_component_box(mask)
+        return mask_to_box(mask)
+
+    def predict_masks(self, predictor: SamPredictor, input_point: Optional[np.ndarray], input_label: Optional[np.ndarray], box: Optional[np.ndarray] = None) -> np.ndarray:
+        # masks at the model input resolution, only the box is mapped to the original image (to_original_box)
+        if self.onnx_decoder is not None and box is None:
+            features = predictor.get_image_embedding().detach().cpu().numpy()
+            return self.onnx_decoder.predict(features, predictor.original_size, input_point, input_label, output_size=predictor.input_size)
+
+        with self.precision_context():
+            masks, scores, logits = predictor.predict_input_masks(
+                point_coords=input_point,
+                point_labels=input_label,
+                box=box,
+                multimask_output=False,
+            )
+        return masks
+
+    def predict_bbox(self, predictor: SamPredictor, input_point: Optional[np.ndarray] = None, input_label: Optional[np.ndarray] = None, box: Optional[np.ndarray] = None) -> Optional[Tuple[int, int, int, int]]:
+        # box of the predicted mask in the original image, None for an empty mask
+        if self.largest_component or (self.onnx_decoder is not None and box is None):
+            masks = self.predict_masks(predictor, input_point, input_label, box)
+            return self.to_original_box(predictor, self.get_bbox(masks[0]))
+
+        # the box of the whole mask needs no mask on the host, the predictor finds it on the decoder output
+        with self.precision_context():
+            boxes, scores, logits = predictor.predict_boxes(
+                point_coords=input_point,
+                point_labels=input_label,
+                box=box,
+                multimask_output=False,
+            )
+        if not boxes[0].any():  # empty mask
+            return None
+
+        x1, y1, x2, y2 = boxes[0].tolist()
+        return (x1, y1, x2-x1+1, y2-y1+1)
+
+    def to_original_box(self, predictor: SamPredictor, bbox: Optional[Tuple[int, int, int, int]]) -> Optional[Tuple[int, int, int, int]]:
+        if bbox is None:
+            return None
+
+        x, y, w, h = bbox
+        x1, y1, x2, y2 = predictor.input_boxes_to_original(np.array([x, y, x+w-1, y+h-1])).tolist()
+        return (x1, y1, x2-x1+1, y2-y1+1)
+
+    def predict_box(self, img_path: str, input_point_list: list, input_label_list: list) -> Optional[Tuple[int, int, int, int]]:
         # set foreground point position
         input_point = np.array(input_point_list)    # [[x1, y1], [x2, y2], ... ,[x3, y3]] 
         input_label = np.array(input_label_list)    # [1, 1, ... ,0]
 
+        if self.tiled:
+            bbox = self.predict_box_tiled(img_path, input_point, input_label)
+            if bbox is not None:
+                return bbox
+
+        self.set_image(img_path)
+
         # run model
-        predictor = SamPredictor(self.sam)
-        predictor.set_image(image)
-        masks, scores, logits = predictor.predict(
-            point_coords=input_point,
-            point_labels=input_label,
-            multimask_output=False,
-        )
-        
-        bbox = self.get_bbox(masks[0])
+        bbox = self.predict_bbox(self.predictor, input_point, input_label)
         return bbox
 
+    def get_window(self, image_size: Tuple[int, int], input_point: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+        # windows are snapped to a grid of half their size, so nearby clicks share one embedding
+        # and every point is at least a quarter window away from an inner edge
+        height, width = image_size
+        size, stride = self.window_size, self.window_size // 2
+        if max(height, width) <= size:
+            return None
+
+        window_w, window_h = min(size, width), min(size, height)
+        center_x, center_y = (input_point.min(axis=0) + input_point.max(axis=0)) / 2
+        x0 = int(np.clip(round((center_x - size / 2) / stride) * stride, 0, width - window_w))
+        y0 = int(np.clip(round((center_y - size / 2) / stride) * stride, 0, height - window_h))
+
+        inside = (input_point[:, 0] >= x0) & (input_point[:, 0] < x0 + window_w) & (input_point[:, 1] >= y0) & (input_point[:, 1] < y0 + window_h)
+        return (x0, y0, window_w, window_h) if inside.all() else None
+
+    def set_window(self, img_path: str, image: np.ndarray, window: Tuple[int, int, int, int]) -> None:
+        key = (self.get_image_key(img_path), window)
+        embedding = self.window_embeddings.get(key)
+        if embedding is None:
+            x0, y0, w, h = window
+            with self.precision_context():
+                self.window_predictor.set_image(image[y0:y0+h, x0:x0+w])
+            embedding = (self.window_predictor.get_image_embedding().float(), self.window_predictor.original_size, self.window_predictor.input_size)
+
+            self.window_embeddings[key] = embedding
+            while len(self.window_embeddings) > self.max_windows:
+                self.window_embeddings.popitem(last=False)
+        self.window_embeddings.move_to_end(key)
+
+        self.window_predictor.set_embedding(*embedding)
+
+    def predict_box_tiled(self, img_path: str, input_point: np.ndarray, input_label: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+        # None when the whole image has to be used: small image, points too far apart, an object cut by the window or no mask
+        self.wait_ready()
+
+        image = self.read_image(img_path)
+        window = self.get_window(image.shape[:2], input_point)
+        if window is None:
+            return None
+
+        x0, y0, w, h = window
+        self.set_window(img_path, image, window)
+        bbox = self.predict_bbox(self.window_predictor, input_point - np.array([x0, y0]), input_label)
+        if bbox is None:
+            return None
+        x, y, box_w, box_h = bbox
 
+        height, width = image.shape[:2]
+        cut_left, cut_top = x == 0 and x0 > 0, y == 0 and y0 > 0
+        cut_right, cut_bottom = x + box_w >= w and x0 + w < width, y + box_h >= h and y0 + h < height
+        if cut_left or cut_top or cut_right or cut_bottom:
+            return None
 
+        return (x + x0, y + y0, box_w, box_h)
@@ -0,0 +1,41 @@
+from typing import Optional
+from pathlib import Path
+import json
+import os
+import platform
+
+import torch
+
+
+def machine_id(device: str) -> str:
+    # the fastest batch size changes with the hardware, the thread count and the torch build
+    return f"{platform.node()}:{platform.machine()}:{os.cpu_count()} cpus:{torch.get_num_threads()} threads:{device}:torch {torch.__version__}"
+
+
+class BatchTuning():
+    """
+    points_per_batch values found by SamAutomaticMaskGenerator.autotune_points_per_batch, stored in a JSON file.
+
+    Entries are keyed by model and machine, each holds the chosen batch size and its measured points/sec.
+    """
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            try:
+                with open(self.path, "r") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                print(f"Batch tuning file \"{self.path}\" is broken, tuning again.")
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.entries.get(key)
+
+    def put(self, key: str, points_per_batch: int, points_per_sec: float) -> None:
+        self.entries[key] = {"points_per_batch": points_per_batch, "points_per_sec": round(points_per_sec, 1)}
+
+        # workers may tune at the same time, the last complete write wins
+        tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
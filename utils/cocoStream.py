@@ -0,0 +1,81 @@
+from typing import Any, Iterator, TextIO, Tuple
+import json
+import re
+
+WHITESPACE = re.compile(r"[ \t\r\n]*")
+
+
+class JsonStream():
+    """Decodes JSON values one at a time from a file, holding only the unread part of the current chunk."""
+    def __init__(self, file: TextIO, chunk_size: int = 1 << 20):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        # next non-whitespace character, "" at the end of the file
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' in \"{self.file.name}\".")
+        self.pos += 1
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a value ending exactly at the end of the buffer may be cut off (e.g. a number)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_coco_items(file_path: str, keys: Tuple[str, ...] = ("images", "annotations")) -> Iterator[Tuple[str, Any]]:
+    """Yields (key, element) for every element of the top-level arrays in keys, other top-level values are skipped."""
+    with open(file_path, "r", encoding="utf-8") as file:
+        stream = JsonStream(file)
+        stream.expect("{")
+
+        while stream.peek() != "}":
+            key = stream.value()
+            stream.expect(":")
+
+            if key in keys and stream.peek() == "[":
+                stream.expect("[")
+                while stream.peek() != "]":
+                    yield key, stream.value()
+                    if stream.peek() == ",":
+                        stream.expect(",")
+                stream.expect("]")
+            else:
+                stream.value()
+
+            if stream.peek() == ",":
+                stream.expect(",")
@@ -0,0 +1,123 @@
+from typing import Optional, Tuple
+from pathlib import Path
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+
+def file_hash(file_path: str, chunk_size: int = 1 << 20) -> str:
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def checkpoint_id(model_name: str, model_path: str) -> str:
+    # hashing a multi-GB checkpoint costs more than it saves, name + size + mtime identify it well enough
+    stat = os.stat(model_path)
+    return f"{model_name}:{Path(model_path).name}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+class EmbeddingCache():
+    """
+    Disk-backed LRU store of SAM image embeddings.
+
+    Every entry is one .npy file holding the image features, read back memory-mapped.
+    The index keeps original_size/input_size per entry, ordered from least to most recently used,
+    and entries are evicted from the front once the total size exceeds max_bytes.
+    """
+    def __init__(self, cache_dir: str, model_id: str, max_bytes: int = 2 * 1024**3):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.index = self.load_index()
+        self.total_bytes = sum(entry["nbytes"] for entry in self.index.values())
+
+    def index_path(self) -> Path:
+        return self.cache_dir / "index.json"
+
+    def entry_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.npy"
+
+    def load_index(self) -> OrderedDict:
+        index = OrderedDict()
+        if self.index_path().exists():
+            try:
+                with open(self.index_path(), "r") as f:
+                    index = OrderedDict(json.load(f))
+            except (OSError, ValueError):
+                print(f"Embedding cache index \"{self.index_path()}\" is broken, starting empty.")
+
+        # drop entries whose data file has gone missing
+        for key in [key for key in index if not self.entry_path(key).exists()]:
+            del index[key]
+        return index
+
+    def save_index(self) -> None:
+        tmp_path = self.index_path().with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path())
+
+    def make_key(self, img_path: str) -> str:
+        return hashlib.sha1(f"{self.model_id}|{file_hash(img_path)}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, Tuple[int, int], Tuple[int, int]]]:
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+
+            try:
+                features = np.load(self.entry_path(key), mmap_mode="r")
+            except (OSError, ValueError):
+                self.remove(key)
+                return None
+
+            # the order is saved on hits too, or the next session would evict in insertion order
+            if next(reversed(self.index)) != key:
+                self.index.move_to_end(key)
+                self.save_index()
+            return features, tuple(entry["original_size"]), tuple(entry["input_size"])
+
+    def put(self, key: str, features: np.ndarray, original_size: Tuple[int, int], input_size: Tuple[int, int]) -> None:
+        with self.lock:
+            if key in self.index:
+                if next(reversed(self.index)) != key:
+                    self.index.move_to_end(key)
+                    self.save_index()
+                return
+
+            # write to a temporary file first so a crash never leaves a truncated entry behind
+            tmp_path = self.entry_path(key).with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, features)
+            os.replace(tmp_path, self.entry_path(key))
+
+            self.index[key] = {
+                "original_size": list(original_size),
+                "input_size": list(input_size),
+                "nbytes": int(features.nbytes),
+            }
+            self.total_bytes += int(features.nbytes)
+            self.evict()
+            self.save_index()
+
+    def remove(self, key: str) -> None:
+        entry = self.index.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry["nbytes"]
+        self.entry_path(key).unlink(missing_ok=True)
+
+    def evict(self) -> None:
+        # keep at least the most recent entry even if it alone exceeds the budget
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            key = next(iter(self.index))
+            self.remove(key)
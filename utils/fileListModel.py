@@ -0,0 +1,93 @@
+from typing import Any, List
+from array import array
+from enum import IntFlag
+import itertools
+import os
+
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, Qt
+from PyQt5.QtGui import QColor
+
+
+class FileStatus(IntFlag):
+    UNLABELED = 0
+    LABELED = 1
+    PREDICTED = 2
+
+
+STATUS_COLORS = {
+    FileStatus.LABELED: QColor(0, 128, 0),
+    FileStatus.PREDICTED: QColor(0, 90, 200),
+}
+
+
+class FileListModel(QAbstractListModel):
+    """
+    Image paths for the file list, stored back to back in one bytes buffer with an offset table.
+
+    A row costs a few bytes instead of a QListWidgetItem, the view only asks for the rows it shows.
+    Every row carries FileStatus flags.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.buffer = bytearray()
+        self.offsets = array("q", [0])      # row i is buffer[offsets[i]:offsets[i+1]]
+        self.statuses = bytearray()
+
+    # override
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.statuses)
+
+    # override
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole) -> Any:
+        if not index.isValid():
+            return None
+
+        row = index.row()
+        if role in (Qt.DisplayRole, Qt.ToolTipRole):
+            return self.path(row)
+        elif role == Qt.ForegroundRole:
+            status = self.statuses[row]
+            # predicted wins over labeled, the box was drawn by SAM and may still need a check
+            for flag in (FileStatus.PREDICTED, FileStatus.LABELED):
+                if status & flag:
+                    return STATUS_COLORS[flag]
+        elif role == Qt.UserRole:
+            return FileStatus(self.statuses[row])
+
+        return None
+
+    def path(self, row: int) -> str:
+        return os.fsdecode(bytes(self.buffer[self.offsets[row]:self.offsets[row+1]]))
+
+    def add_paths(self, paths: List[str]) -> None:
+        if not paths:
+            return
+
+        encoded = [os.fsencode(path) for path in paths]
+        first = len(self.statuses)
+
+        self.beginInsertRows(QModelIndex(), first, first + len(encoded) - 1)
+        ends = itertools.accumulate((len(path) for path in encoded), initial=len(self.buffer))
+        self.offsets.extend(itertools.islice(ends, 1, None))
+        self.buffer += b"".join(encoded)
+        self.statuses += bytes(len(encoded))
+        self.endInsertRows()
+
+    def clear(self) -> None:
+        self.beginResetModel()
+        self.buffer = bytearray()
+        self.offsets = array("q", [0])
+        self.statuses = bytearray()
+        self.endResetModel()
+
+    def status(self, row: int) -> FileStatus:
+        return FileStatus(self.statuses[row])
+
+    def set_status(self, row: int, status: FileStatus) -> None:
+        if self.statuses[row] != status:
+            self.statuses[row] = status
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.ForegroundRole, Qt.UserRole])
+
+    def add_status(self, row: int, flag: FileStatus) -> None:
+        self.set_status(row, FileStatus(self.statuses[row] | flag))
@@ -0,0 +1,79 @@
+from typing import Iterable, Iterator, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import time
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def natural_key(text: str) -> list:
+    # "img2.jpg" sorts before "img10.jpg"
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", text)]
+
+def list_dir(path: str, extensions: Iterable[str]) -> Tuple[List[str], List[str]]:
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+                        files.append(entry.path)
+                except OSError:
+                    continue
+    except OSError as e:
+        print(f"Cannot scan \"{path}\": {e}")
+
+    files.sort(key=lambda file: natural_key(os.path.basename(file)))
+    dirs.sort(key=lambda dir: natural_key(os.path.basename(dir)))
+    return files, dirs
+
+def iter_images(root: str, extensions: Iterable[str] = IMAGE_EXTENSIONS, recursive: bool = False, workers: int = 8) -> Iterator[str]:
+    # subdirectories are listed ahead on a thread pool (slow network storage), but yielded depth-first in natural order
+    extensions = tuple(ext.lower() for ext in extensions)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        stack = [executor.submit(list_dir, root, extensions)]
+        while stack:
+            files, dirs = stack.pop().result()
+            yield from files
+
+            if recursive:
+                stack.extend(executor.submit(list_dir, dir, extensions) for dir in reversed(dirs))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)     # an interrupted scan drops the pending listings
+
+
+class FileScanner(QThread):
+    found = pyqtSignal(list)    # a chunk of image paths, in scan order
+
+    def __init__(self, root: str, recursive: bool = False, extensions: Iterable[str] = IMAGE_EXTENSIONS,
+                 chunk_size: int = 2000, chunk_interval: float = 0.1, parent=None):
+        super().__init__(parent)
+        self.root = root
+        self.recursive = recursive
+        self.extensions = extensions
+        self.chunk_size = chunk_size
+        self.chunk_interval = chunk_interval    # seconds, so a slow scan still shows results early
+
+    # override
+    def run(self) -> None:
+        chunk = []
+        last_emit = 0.0     # the first path is sent right away so the first image shows up immediately
+
+        for path in iter_images(self.root, self.extensions, self.recursive):
+            if self.isInterruptionRequested():
+                return
+
+            chunk.append(path)
+            if len(chunk) >= self.chunk_size or time.monotonic() - last_emit >= self.chunk_interval:
+                self.found.emit(chunk)
+                chunk = []
+                last_emit = time.monotonic()
+
+        if chunk:
+            self.found.emit(chunk)
@@ -1,39 +1,327 @@
 from typing import Tuple, List
 from pathlib import Path
-from collections import OrderedDict
+from collections import defaultdict
+from array import array
 from lxml import etree as ET
+import numpy as np
 import json
+import os
 
 from PyQt5.QtCore import QPointF, Qt, QSize, QPoint
 from PyQt5.QtWidgets import QFileDialog, QGraphicsRectItem, QListWidget
 from PyQt5.QtGui import QTransform
 
 from utils.classSelectionDialog import CategoryDialog
+from utils.cocoStream import iter_coco_items
+
+class CocoDataset():
+    """
+    COCO annotations of the labeled images, written to annotations.json in place.
+
+    The file is laid out as padded slots, one for the categories, one for every image and one for the annotations
+    of every image. A save overwrites only the slots of the images changed since the last one and appends new images
+    into the space reserved after the images array. The whole file is written again only when a slot outgrows its
+    padding, the reserved space runs out or the file is not the one written last.
+    """
+    def __init__(self):
+        self.images = {}                # file_name -> image info, ids are assigned once in insertion order
+        self.image_list = []            # image id -> image info
+        self.annotations = {}           # image id -> annotations of that image
+        self.categories = []
+        self.next_annotation_id = 0
+        self.fragments = {}             # image id -> serialized image and annotations, dropped when they change
+
+        self.file_state = None          # (path, size, mtime) of the file as written last
+        self.slots = {}                 # "categories", ("image", id), ("annotations", id) -> [offset, capacity]
+        self.images_gap = None          # [offset, capacity] of the space reserved for new images
+        self.end_offset = 0             # offset of the closing "]}"
+        self.first_annotated = None     # id of the first image with annotations, the only slot without a leading comma
+        self.dirty = set()              # image ids changed since the last write
+        self.categories_dirty = False
+
+    def set_image(self, file_name: str, width: int, height: int) -> int:
+        image = self.images.get(file_name)
+        if image is None:
+            image = self.images[file_name] = {"id": len(self.images), "file_name": file_name, "width": width, "height": height}
+            self.image_list.append(image)
+            self.dirty.add(image["id"])
+        elif (image["width"], image["height"]) != (width, height):
+            image.update(width=width, height=height)
+            self.fragments.pop(image["id"], None)
+            self.dirty.add(image["id"])
+
+        return image["id"]
+
+    def set_annotations(self, image_id: int, annotations: list) -> None:
+        # unchanged boxes keep their id, edited boxes take over the ids of the removed ones, only added boxes get new ids
+        previous = self.annotations.get(image_id, [])
+        unchanged = defaultdict(list)
+        for annot in previous:
+            unchanged[(annot["category_id"], tuple(annot["bbox"]))].append(annot["id"])
+
+        for annot in annotations:
+            ids = unchanged.get((annot["category_id"], tuple(annot["bbox"])))
+            annot["id"] = ids.pop(0) if ids else None
+        used = {annot["id"] for annot in annotations}
+        free_ids = [annot["id"] for annot in previous if annot["id"] not in used]
+        for annot in annotations:
+            if annot["id"] is None:
+                if free_ids:
+                    annot["id"] = free_ids.pop(0)
+                else:
+                    annot["id"] = self.next_annotation_id
+                    self.next_annotation_id += 1
+
+        if annotations != previous:
+            self.annotations[image_id] = annotations
+            self.fragments.pop(image_id, None)
+            self.dirty.add(image_id)
+
+    def set_categories(self, categories: list) -> None:
+        if categories != self.categories:
+            self.categories = categories
+            self.categories_dirty = True
+
+    def fragment(self, image_id: int) -> Tuple[str, str]:
+        fragment = self.fragments.get(image_id)
+        if fragment is None:
+            image = self.image_list[image_id]
+            image_annotations = self.annotations.get(image_id, [])
+            fragment = (dump_compact(image), ",".join(dump_compact(annot) for annot in image_annotations))
+            self.fragments[image_id] = fragment
+        return fragment
+
+    def to_json(self) -> str:
+        images, annotations = [], []
+        for image in self.images.values():
+            image_fragment, annotations_fragment = self.fragment(image["id"])
+            images.append(image_fragment)
+            if annotations_fragment:
+                annotations.append(annotations_fragment)
+
+        return f'{{"images":[{",".join(images)}],"annotations":[{",".join(annotations)}],"categories":{dump_compact(self.categories)}}}'
+
+    def write(self, save_path: str) -> None:
+        patches = self.plan_patches(save_path)
+        if patches is None:
+            self.write_full(save_path)
+        else:
+            with open(save_path, "r+b") as file:
+                for offset, data in patches:
+                    file.seek(offset)
+                    file.write(data)
+            self.remember_file(save_path)
+
+        self.dirty.clear()
+        self.categories_dirty = False
+
+    def remember_file(self, save_path: str) -> None:
+        stat = os.stat(save_path)
+        self.file_state = (os.path.abspath(save_path), stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def padded(text: str, capacity: int) -> bytes:
+        # fragments are plain ASCII, json.dumps escapes the rest
+        return (text + " " * (capacity - len(text))).encode("ascii")
+
+    @staticmethod
+    def slot_capacity(length: int) -> int:
+        return length + max(32, length // 2)
+
+    def write_full(self, save_path: str) -> None:
+        parts, offset = [], 0
+        self.slots = {}
+
+        def emit(text: str, slot_key=None) -> None:
+            nonlocal offset
+            capacity = self.slot_capacity(len(text)) if slot_key is not None else len(text)
+            parts.append(self.padded(text, capacity))
+            if slot_key is not None:
+                self.slots[slot_key] = [offset, capacity]
+            offset += capacity
+
+        emit('{"categories":')
+        emit(dump_compact(self.categories), "categories")
+        emit(',"images":[')
+        images_bytes = offset
+        for index, image in enumerate(self.images.values()):
+            emit(("," if index else "") + self.fragment(image["id"])[0], ("image", image["id"]))
+        gap = max(4096, (offset - images_bytes) // 4)
+        self.images_gap = [offset, gap]
+        emit(" " * gap)
+
+        emit('],"annotations":[')
+        self.first_annotated = None
+        for image in self.images.values():
+            annotations_fragment = self.fragment(image["id"])[1]
+            comma = "," if self.first_annotated is not None and annotations_fragment else ""
+            if annotations_fragment and self.first_annotated is None:
+                self.first_annotated = image["id"]
+            emit(comma + annotations_fragment, ("annotations", image["id"]))
+        self.end_offset = offset
+        emit("]}")
+
+        tmp_path = f"{save_path}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(b"".join(parts))
+        os.replace(tmp_path, save_path)
+        self.remember_file(save_path)
+
+    def plan_patches(self, save_path: str) -> list:
+        # list of (offset, bytes) writes bringing the file up to date, None when it has to be written whole
+        try:
+            stat = os.stat(save_path)
+        except OSError:
+            return None
+        if self.file_state != (os.path.abspath(save_path), stat.st_size, stat.st_mtime_ns):
+            return None
+
+        patches = []
+        if self.categories_dirty:
+            offset, capacity = self.slots["categories"]
+            text = dump_compact(self.categories)
+            if len(text) > capacity:
+                return None
+            patches.append((offset, self.padded(text, capacity)))
+
+        first_annotated = self.first_annotated
+        gap_offset, gap_capacity = self.images_gap
+        end_offset = self.end_offset
+        new_slots = {}
+        for image_id in sorted(self.dirty):
+            image_fragment, annotations_fragment = self.fragment(image_id)
+
+            # image slot, new images are carved out of the reserved space
+            image_text = ("," if image_id else "") + image_fragment
+            if ("image", image_id) in self.slots:
+                offset, capacity = self.slots[("image", image_id)]
+                if len(image_text) > capacity:
+                    return None
+            else:
+                capacity = self.slot_capacity(len(image_text))
+                if capacity > gap_capacity:
+                    return None
+                offset = gap_offset
+                gap_offset, gap_capacity = gap_offset + capacity, gap_capacity - capacity
+                new_slots[("image", image_id)] = [offset, capacity]
+            patches.append((offset, self.padded(image_text, capacity)))
+
+            # annotations slot, leading commas only stay valid while the first annotated image keeps annotations
+            # and no earlier image gains some
+            if annotations_fragment:
+                if first_annotated is None:
+                    first_annotated = image_id
+                elif image_id < first_annotated:
+                    return None
+            elif image_id == first_annotated:
+                return None
+            comma = "," if annotations_fragment and image_id != first_annotated else ""
+            annotations_text = comma + annotations_fragment
+
+            if ("annotations", image_id) in self.slots:
+                offset, capacity = self.slots[("annotations", image_id)]
+                if len(annotations_text) > capacity:
+                    return None
+            else:
+                # new images are appended to the end of the annotations array
+                capacity = self.slot_capacity(len(annotations_text))
+                offset, end_offset = end_offset, end_offset + capacity
+                new_slots[("annotations", image_id)] = [offset, capacity]
+            patches.append((offset, self.padded(annotations_text, capacity)))
+
+        patches.append((end_offset, b"]}"))
+        self.slots.update(new_slots)
+        self.images_gap = [gap_offset, gap_capacity]
+        self.end_offset = end_offset
+        self.first_annotated = first_annotated
+        return patches
+
 
 class Data():
-    coco_images = OrderedDict()
-    coco_images_info = []
-    coco_annotations_info = []
-    coco_categories_info = []
+    coco_dataset = CocoDataset()
 
     is_modified = False
 
 
+class CocoIndex():
+    indexes = {}    # annotations.json path -> CocoIndex
+    stream_threshold = 256 * 1024**2    # files larger than this are streamed instead of loaded whole
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.mtime = None
+        self.image_ids = {}                         # file_name -> image id
+        self.annotations = defaultdict(list)        # image id -> annotations
+        self.load()
+
+    @classmethod
+    def get(cls, file_path: str) -> "CocoIndex":
+        # one index per annotations.json, parsed again only when the file has changed
+        index = cls.indexes.get(file_path)
+        if index is None or os.path.getmtime(file_path) != index.mtime:
+            index_cls = CocoStreamIndex if os.path.getsize(file_path) > cls.stream_threshold else CocoIndex
+            index = cls.indexes[file_path] = index_cls(file_path)
+
+        return index
+
+    def load(self) -> None:
+        mtime = os.path.getmtime(self.file_path)
+        with open(self.file_path, "r") as file:
+            data = json.load(file)
+
+        self.image_ids = {img["file_name"]: img["id"] for img in data["images"]}
+        self.annotations = defaultdict(list)
+        for annot in data["annotations"]:
+            self.annotations[annot["image_id"]].append(annot)
+        self.mtime = mtime
+
+    def get_annotations(self, file_name: str) -> list:
+        image_id = self.image_ids.get(file_name)
+        return self.annotations.get(image_id, []) if image_id is not None else []
+
+
+class CocoStreamIndex(CocoIndex):
+    def load(self) -> None:
+        # annotations are parsed one by one into flat arrays sorted by image id, the document is never held in memory
+        mtime = os.path.getmtime(self.file_path)
+        image_ids = {}
+        annot_image_ids, category_ids, boxes = array("q"), array("q"), array("d")
+
+        for key, item in iter_coco_items(self.file_path):
+            if key == "images":
+                image_ids[item["file_name"]] = item["id"]
+            else:
+                annot_image_ids.append(item["image_id"])
+                category_ids.append(item["category_id"])
+                boxes.extend(item["bbox"][:4])
+
+        annot_image_ids = np.frombuffer(annot_image_ids, dtype=np.int64)
+        order = np.argsort(annot_image_ids, kind="stable")
+        self.annot_image_ids = annot_image_ids[order]
+        self.category_ids = np.frombuffer(category_ids, dtype=np.int64)[order]
+        self.boxes = np.frombuffer(boxes, dtype=np.float64).reshape(-1, 4)[order].astype(np.float32)
+        self.image_ids = image_ids
+        self.mtime = mtime
+
+    def get_annotations(self, file_name: str) -> list:
+        image_id = self.image_ids.get(file_name)
+        if image_id is None:
+            return []
+
+        start = np.searchsorted(self.annot_image_ids, image_id, side="left")
+        end = np.searchsorted(self.annot_image_ids, image_id, side="right")
+        return [{"image_id": image_id, "category_id": int(category_id), "bbox": box.tolist()}
+                for category_id, box in zip(self.category_ids[start:end], self.boxes[start:end])]
+
+
 def track_changes(func):
     def wrapper(*args, **kwargs):
         Data.is_modified = True
         return func(*args, **kwargs)
     return wrapper
 
-def reorder(annotations: list) -> None:
-    for idx, annot in enumerate(annotations):
-        annot["id"] = idx
-
-def get_key_by_value(dictionary: dict, value):
-    for key, val in dictionary.items():
-        if val == value:
-            return key
-    return None
+def dump_compact(data) -> str:
+    return json.dumps(data, separators=(",", ":"))
 
 def to_orig_pos(scenePos: QPointF, scaled_size: QSize, ori_size: QSize) -> Tuple[int, int]:
     scale_x = ori_size.width() / scaled_size.width()
@@ -98,30 +386,21 @@ def parse_xml(file_path: str, scaled_size: QSize, ori_size: QSize) -> List[Tuple
     return bboxes
 
 def parse_coco(file_path: str, file_name: str, classes_mapping: dict, scaled_size: QSize, ori_size: QSize) -> List[Tuple[QPointF, QPointF, str]]:
-    image_id = -1
     bboxes = []
-
-    with open(file_path, "r") as file:
-        data = json.load(file)
-
-    for img in data["images"]:
-        if img["file_name"] == file_name:
-            image_id = img["id"]
-            break
-    
-    for annot in data["annotations"]:
-        if annot["image_id"] == image_id:
-            classes = get_key_by_value(classes_mapping, annot["category_id"])
-            if classes is None:
-                print(f"The categories of \"{file_path}\" and \"classes.txt\" are inconsistent.")
-                return bboxes
-            else:
-                bbox = annot["bbox"]
-                x1, y1, w, h = int(bbox[0]), int(bbox[1]), int(bbox[2]), int(bbox[3])
-
-                p_topLeft = to_scaled_pos(x1, y1, scaled_size, ori_size)
-                p_bottomRight = to_scaled_pos(x1+w, y1+h, scaled_size, ori_size)
-                bboxes.append((classes, p_topLeft, p_bottomRight))
+    category_mapping = {id: classes for classes, id in classes_mapping.items()}
+
+    for annot in CocoIndex.get(file_path).get_annotations(file_name):
+        classes = category_mapping.get(annot["category_id"])
+        if classes is None:
+            print(f"The categories of \"{file_path}\" and \"classes.txt\" are inconsistent.")
+            return bboxes
+        else:
+            bbox = annot["bbox"]
+            x1, y1, w, h = int(bbox[0]), int(bbox[1]), int(bbox[2]), int(bbox[3])
+
+            p_topLeft = to_scaled_pos(x1, y1, scaled_size, ori_size)
+            p_bottomRight = to_scaled_pos(x1+w, y1+h, scaled_size, ori_size)
+            bboxes.append((classes, p_topLeft, p_bottomRight))
     
     return bboxes
 
@@ -160,31 +439,19 @@ def box_to_pascal(classes: str, box: QGraphicsRectItem, ori_size: QSize, scaled_
 
     return obj
 
-def box_to_coco(file_name: Path, box_labels: QListWidget, classes_mapping: dict, scaled_size: QSize, ori_size: QSize) -> None:
-    coco_images(file_name, ori_size)
-    coco_annotations(file_name, box_labels, classes_mapping, scaled_size, ori_size)
+def box_to_coco(file_name: str, box_labels: QListWidget, classes_mapping: dict, scaled_size: QSize, ori_size: QSize) -> None:
+    image_id = coco_images(file_name, ori_size)
+    coco_annotations(image_id, box_labels, classes_mapping, scaled_size, ori_size)
     coco_categories(classes_mapping)
 
-def coco_images(file_name: Path, ori_size: QSize):
-    Data.coco_images[file_name] = None
-    image_id = list(Data.coco_images.keys()).index(file_name)
-    width = ori_size.width()
-    height = ori_size.height()
+def coco_images(file_name: str, ori_size: QSize) -> int:
+    return Data.coco_dataset.set_image(file_name, ori_size.width(), ori_size.height())
 
-    if image_id not in [img["id"] for img in Data.coco_images_info]:
-        Data.coco_images_info.append({
-            "id": image_id,
-            "file_name": file_name, 
-            "width": width, 
-            "height": height
-        })
-
-def coco_annotations(file_name: Path, box_labels: QListWidget, classes_mapping: dict, scaled_size: QSize, ori_size: QSize) -> None:
+def coco_annotations(image_id: int, box_labels: QListWidget, classes_mapping: dict, scaled_size: QSize, ori_size: QSize) -> None:
     iscrowd = 0
     ignore = 0
-    image_id = list(Data.coco_images).index(file_name)
     segmentation = []
-    temp_annotations = [annot for annot in Data.coco_annotations_info if annot["image_id"] != image_id]
+    annotations = []
 
     for row in range(box_labels.count()):
         item = box_labels.item(row)
@@ -200,9 +467,8 @@ def coco_annotations(file_name: Path, box_labels: QListWidget, classes_mapping:
 
             area = float(x2-x1) * float(y2-y1)
             category_id = classes_mapping[classes]
-            id = len(Data.coco_annotations_info)               
             
-            temp_annotations.append({
+            annotations.append({
                 "iscrowd": iscrowd, 
                 "ignore": ignore, 
                 "image_id": image_id, 
@@ -210,21 +476,21 @@ def coco_annotations(file_name: Path, box_labels: QListWidget, classes_mapping:
                 "area": area, 
                 "segmentation": segmentation, 
                 "category_id": category_id, 
-                "id": id
+                "id": None      # assigned by the dataset
             })
-    Data.coco_annotations_info = temp_annotations
-    reorder(Data.coco_annotations_info)
+    Data.coco_dataset.set_annotations(image_id, annotations)
 
 def coco_categories(classes_mapping: dict) -> None:
-    Data.coco_categories_info = []    # initial
+    categories = []
 
     supercategory = "none"
     for classes, id in classes_mapping.items():
-        Data.coco_categories_info.append({
+        categories.append({
             "supercategory": supercategory, 
             "id": id, 
             "name": classes
     })
+    Data.coco_dataset.set_categories(categories)
 
 def write_yolo_file(boxes: list, save_path: str) -> None:
     with open(save_path, "w") as f:
@@ -292,7 +558,7 @@ def write_pascal_file(folder: str, filename: str, file_path: str, width: str, he
 
 def write_coco_file(data: dict, save_path: str) -> None:
     with open(save_path, "w") as file:
-        json.dump(data, file, indent=4)
+        json.dump(data, file, separators=(",", ":"))
 
     print(f"Annotation to {save_path}")
 
@@ -334,12 +600,8 @@ def save_pascal_format(file_path: Path, box_labels: QListWidget, classes_mapping
 def save_coco_format(file_path: Path, box_labels: QListWidget, classes_mapping: dict, scaled_size: QSize, ori_size: QSize, options) -> None:
     file_name = file_path.name
     box_to_coco(file_name, box_labels, classes_mapping, scaled_size, ori_size)
-    data = {
-        "images": Data.coco_images_info,
-        "annotations": Data.coco_annotations_info,
-        "categories": Data.coco_categories_info
-    }
 
     save_path, _ = QFileDialog.getSaveFileName(None, "Save File", str(file_path.parent / "annotations.json"), "JSON Files (*.json)", options=options)
     if save_path:
-        write_coco_file(data, save_path)
\ No newline at end of file
+        Data.coco_dataset.write(save_path)
+        print(f"Annotation to {save_path}")
\ No newline at end of file
@@ -0,0 +1,182 @@
+from typing import List, Tuple
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import threading
+
+import numpy as np
+import cv2
+from PyQt5.QtGui import QImage, QImageIOHandler, QImageReader
+from PyQt5.QtCore import QSize, Qt
+
+# reduced JPEG decodes, largest factor first
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+class DecodedImage():
+    """An RGB image decoded once, with a QImage sharing its buffer (no copy)."""
+    def __init__(self, rgb: np.ndarray):
+        rgb.flags.writeable = False     # shared between threads, nobody may modify it in place
+        self.rgb = rgb
+        self.height, self.width = rgb.shape[:2]
+        self.qimage = QImage(rgb.data, self.width, self.height, rgb.strides[0], QImage.Format_RGB888)
+
+    @property
+    def nbytes(self) -> int:
+        return self.rgb.nbytes
+
+    def size(self) -> QSize:
+        return QSize(self.width, self.height)
+
+
+class DisplayImage():
+    """An image decoded at the size it is shown at, with the size of the original file for the box mapping."""
+    def __init__(self, rgb: np.ndarray, original_size: QSize):
+        self.rgb = rgb      # keeps the buffer of qimage alive
+        self.qimage = QImage(rgb.data, rgb.shape[1], rgb.shape[0], rgb.strides[0], QImage.Format_RGB888)
+        self.original_size = original_size
+
+    def size(self) -> QSize:
+        return self.original_size
+
+
+def read_rgb(img_path: str, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+    image = cv2.imread(img_path, flags)
+    if image is None:
+        raise OSError(f"Cannot read image \"{img_path}\".")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def read_image_size(img_path: str) -> QSize:
+    # only the header is read, an invalid size means Qt cannot parse it
+    reader = QImageReader(img_path)
+    size = reader.size()
+    if size.isValid() and reader.transformation() & QImageIOHandler.TransformationRotate90:
+        size.transpose()    # cv2.imread applies the EXIF orientation too
+    return size
+
+def read_display_image(img_path: str, view_size: QSize, image_cache: "ImageCache" = None) -> DisplayImage:
+    original_size = read_image_size(img_path)
+    if image_cache is not None and (not original_size.isValid() or original_size.width() * original_size.height() * 3 <= image_cache.max_bytes):
+        # the full decode is kept for the SAM encode of the same image, the view only gets a downscaled copy
+        rgb = image_cache.get(img_path).rgb
+        original_size = QSize(rgb.shape[1], rgb.shape[0])
+    elif not original_size.isValid():
+        rgb = read_rgb(img_path)
+        original_size = QSize(rgb.shape[1], rgb.shape[0])
+    else:
+        display_size = original_size.scaled(view_size, Qt.KeepAspectRatio)
+        flags = cv2.IMREAD_COLOR
+        for factor, reduced_flags in REDUCED_FLAGS:
+            # the decoder skips the detail that the downscale would throw away anyway
+            if original_size.width() // factor >= display_size.width() and original_size.height() // factor >= display_size.height():
+                flags = reduced_flags
+                break
+        rgb = read_rgb(img_path, flags)
+
+    display_size = original_size.scaled(view_size, Qt.KeepAspectRatio)
+    if (rgb.shape[1], rgb.shape[0]) != (display_size.width(), display_size.height()):
+        interpolation = cv2.INTER_AREA if rgb.shape[1] > display_size.width() else cv2.INTER_LINEAR
+        rgb = cv2.resize(rgb, (display_size.width(), display_size.height()), interpolation=interpolation)
+
+    return DisplayImage(np.ascontiguousarray(rgb), original_size)
+
+
+class ImageCache():
+    """
+    Thread-safe LRU of decoded images keyed by (path, mtime), bounded by the bytes of the pixel buffers.
+
+    The view and SA read through it on the GUI and the prefetch threads alike, so a file is decoded once for both.
+    A thread asking for a file that another one is decoding waits for that decode.
+    """
+    def __init__(self, max_bytes: int = 1024**3):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.images = OrderedDict()
+        self.lock = threading.Condition()
+        self.decoding = set()       # keys being decoded right now
+
+    def get(self, img_path: str) -> DecodedImage:
+        key = (img_path, os.path.getmtime(img_path))
+        with self.lock:
+            while key in self.decoding:
+                self.lock.wait()
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+                return image
+            self.decoding.add(key)
+
+        # decoding runs outside the lock
+        try:
+            image = DecodedImage(read_rgb(img_path))
+            self.put(key, image)
+        finally:
+            with self.lock:
+                self.decoding.discard(key)
+                self.lock.notify_all()
+        return image
+
+    def put(self, key: Tuple[str, float], image: DecodedImage) -> None:
+        with self.lock:
+            if key in self.images:
+                return
+            if image.nbytes > self.max_bytes:
+                return      # handed to the caller but not kept
+
+            self.images[key] = image
+            self.total_bytes += image.nbytes
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+
+    def clear(self) -> None:
+        with self.lock:
+            self.images.clear()
+            self.total_bytes = 0
+
+
+class DisplayPrefetcher():
+    """
+    Decodes and downscales images for the view on a thread pool, so next/prev find them ready.
+
+    With an image_cache the full decode is shared with SA, otherwise JPEGs are decoded at a reduced size.
+    Results are keyed by (path, mtime, view size) and only the most recent max_images are kept.
+    Used from the GUI thread only.
+    """
+    def __init__(self, workers: int = 2, max_images: int = 6, image_cache: ImageCache = None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.image_cache = image_cache
+        self.max_images = max_images
+        self.futures = OrderedDict()
+
+    def make_key(self, img_path: str, view_size: QSize) -> tuple:
+        return (img_path, os.path.getmtime(img_path), view_size.width(), view_size.height())
+
+    def submit(self, key: tuple) -> Future:
+        future = self.futures.get(key)
+        if future is None or future.cancelled():
+            img_path, _, width, height = key
+            future = self.futures[key] = self.executor.submit(read_display_image, img_path, QSize(width, height), self.image_cache)
+        self.futures.move_to_end(key)
+
+        while len(self.futures) > self.max_images:
+            _, stale = self.futures.popitem(last=False)
+            stale.cancel()      # no-op if it is already running
+        return future
+
+    def get(self, img_path: str, view_size: QSize) -> DisplayImage:
+        # waits for a prefetch in flight, decodes right away otherwise
+        key = self.make_key(img_path, view_size)
+        future = self.submit(key)
+        try:
+            return future.result()
+        except Exception:
+            self.futures.pop(key, None)     # a failed read is retried next time
+            raise
+
+    def prefetch(self, img_paths: List[str], view_size: QSize) -> None:
+        for img_path in img_paths:
+            try:
+                self.submit(self.make_key(img_path, view_size))
+            except OSError:
+                continue
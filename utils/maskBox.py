@@ -0,0 +1,48 @@
+from typing import Optional, Tuple
+
+import numpy as np
+import cv2
+
+
+def mask_to_box(mask: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+    """(x, y, w, h) around every foreground pixel, as cv2.boundingRect, None for an empty mask."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+
+    x1, y1 = int(cols[0]), int(rows[0])
+    return (x1, y1, int(cols[-1]) - x1 + 1, int(rows[-1]) - y1 + 1)
+
+def downsample_any(mask: np.ndarray, factor: int) -> np.ndarray:
+    # a cell of factor x factor pixels is foreground if any of its pixels is, so thin parts and small blobs survive
+    rows = np.logical_or.reduceat(mask, np.arange(0, mask.shape[0], factor), axis=0)
+    return np.logical_or.reduceat(rows, np.arange(0, mask.shape[1], factor), axis=1)
+
+def largest_component_box(mask: np.ndarray, max_side: int = 256) -> Optional[Tuple[int, int, int, int]]:
+    """
+    (x, y, w, h) around the largest 8-connected component, None for an empty mask.
+
+    Components are labeled on a copy downsampled to about max_side, the box is then fitted at full resolution
+    inside the cells of the chosen component. Components that only touch at the cell level count as one.
+    """
+    mask = mask.astype(bool, copy=False)
+    factor = max(1, -(-max(mask.shape[:2]) // max_side))
+    small = downsample_any(mask, factor) if factor > 1 else mask
+
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(small.astype(np.uint8), connectivity=8)
+    if count <= 1:
+        return None
+    if count == 2:
+        return mask_to_box(mask)      # a single component, nothing to drop
+
+    best = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    x, y, w, h = (int(val) for val in stats[best, :4])
+    if factor == 1:
+        return (x, y, w, h)
+
+    # only the pixels in the cells of the component are looked at
+    region = mask[y*factor:(y+h)*factor, x*factor:(x+w)*factor]
+    component = (labels[y:y+h, x:x+w] == best).repeat(factor, axis=0).repeat(factor, axis=1)
+    box = mask_to_box(region & component[:region.shape[0], :region.shape[1]])
+    return (box[0] + x*factor, box[1] + y*factor, box[2], box[3])
@@ -0,0 +1,112 @@
+from typing import Optional, Tuple
+from pathlib import Path
+import hashlib
+import inspect
+import os
+
+import numpy as np
+import torch
+
+from segment_anything.modeling import Sam
+from segment_anything.utils.onnx import SamOnnxModel
+from segment_anything.utils.transforms import ResizeLongestSide
+
+# bumped whenever the exported graph changes, so files exported by older versions are replaced
+EXPORT_VERSION = 2
+
+
+class SingleMaskOnnxModel(SamOnnxModel):
+    """
+    SamOnnxModel returning the single-mask output (token 0) for any number of points,
+    like SamPredictor with multimask_output=False. SamOnnxModel picks the best multimask
+    output for prompts of fewer than 3 points instead.
+    """
+    def select_masks(self, masks: torch.Tensor, iou_preds: torch.Tensor, num_points: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        return masks[:, :1], iou_preds[:, :1]
+
+
+class OnnxDecoder():
+    """
+    Runs the prompt encoder and mask decoder of SAM with ONNX Runtime on CPU.
+
+    The decoder is exported once per checkpoint to onnx_dir and reused by later sessions,
+    a changed checkpoint gets a new file and the stale ones are removed.
+    Requires onnx (for the export) and onnxruntime.
+    """
+    def __init__(self, sam: Sam, onnx_dir: str, model_id: str):
+        import onnxruntime  # type: ignore
+
+        self.mask_threshold = sam.mask_threshold
+        self.transform = ResizeLongestSide(sam.image_encoder.img_size)
+        self.mask_input_size = [4 * size for size in sam.prompt_encoder.image_embedding_size]
+
+        onnx_dir = Path(onnx_dir)
+        onnx_dir.mkdir(parents=True, exist_ok=True)
+        onnx_path = onnx_dir / f"decoder_{hashlib.sha1(f'{model_id}:{EXPORT_VERSION}'.encode()).hexdigest()[:16]}.onnx"
+        if not onnx_path.exists():
+            for stale_path in onnx_dir.glob("decoder_*.onnx"):
+                stale_path.unlink()
+            self.export(sam, onnx_path)
+
+        self.session = onnxruntime.InferenceSession(str(onnx_path), providers=["CPUExecutionProvider"])
+
+    @staticmethod
+    def export(sam: Sam, onnx_path: Path) -> None:
+        onnx_model = SingleMaskOnnxModel(sam, return_single_mask=True)
+
+        embed_dim = sam.prompt_encoder.embed_dim
+        embed_size = sam.prompt_encoder.image_embedding_size
+        mask_input_size = [4 * size for size in embed_size]
+        dummy_inputs = {
+            "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
+            "point_coords": torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float),
+            "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
+            "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
+            "has_mask_input": torch.tensor([1], dtype=torch.float),
+            "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float),
+        }
+        dynamic_axes = {
+            "point_coords": {1: "num_points"},
+            "point_labels": {1: "num_points"},
+        }
+
+        # export to a temporary file first so an interrupted export is never picked up
+        # SamOnnxModel is written for the TorchScript exporter, torch >= 2.9 defaults to the dynamo one
+        exporter_args = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+        tmp_path = onnx_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            torch.onnx.export(
+                onnx_model,
+                tuple(dummy_inputs.values()),
+                f,
+                export_params=True,
+                verbose=False,
+                opset_version=17,
+                do_constant_folding=True,
+                input_names=list(dummy_inputs.keys()),
+                output_names=["masks", "iou_predictions", "low_res_masks"],
+                dynamic_axes=dynamic_axes,
+                **exporter_args,
+            )
+        os.replace(tmp_path, onnx_path)
+        print(f"Exported mask decoder to {onnx_path}")
+
+    def predict(self, features: np.ndarray, original_size: Tuple[int, int], point_coords: np.ndarray, point_labels: np.ndarray,
+                output_size: Optional[Tuple[int, int]] = None) -> np.ndarray:
+        # with output_size=input_size the graph stops at the input resolution, the mask is never upsampled to original_size
+        # without a box prompt the exported model expects a padding point with label -1
+        coords = np.concatenate([point_coords, np.array([[0.0, 0.0]])], axis=0)[None, :, :]
+        labels = np.concatenate([point_labels, np.array([-1])], axis=0)[None, :].astype(np.float32)
+        coords = self.transform.apply_coords(coords, original_size).astype(np.float32)
+
+        ort_inputs = {
+            "image_embeddings": features.astype(np.float32),
+            "point_coords": coords,
+            "point_labels": labels,
+            "mask_input": np.zeros((1, 1, *self.mask_input_size), dtype=np.float32),
+            "has_mask_input": np.zeros(1, dtype=np.float32),
+            "orig_im_size": np.array(output_size or original_size, dtype=np.float32),
+        }
+        masks, _, _ = self.session.run(None, ort_inputs)
+
+        return masks[0] > self.mask_threshold
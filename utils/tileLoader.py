@@ -0,0 +1,118 @@
+from typing import Iterable, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from PyQt5.QtCore import QObject, QRect, QSize, pyqtSignal
+from PyQt5.QtGui import QImage, QImageIOHandler, QImageReader
+
+TILE_SIZE = 512     # pixels of a tile at its own level
+LEVEL_BYTES = 256 * 1024**2     # largest whole level decoded for formats without region reads
+
+
+def read_tile(img_path: str, rect: QRect, size: QSize) -> QImage:
+    # only rect of the original image is decoded, for formats whose plugin supports clipping (JPEG)
+    reader = QImageReader(img_path)
+    reader.setAutoTransform(False)
+    reader.setClipRect(rect)
+    reader.setScaledSize(size)
+    return reader.read()
+
+def read_level(img_path: str, size: QSize) -> QImage:
+    # the whole image at the size of a level, formats without region reads (PNG, TIFF, ...) decode the full file for it
+    reader = QImageReader(img_path)
+    reader.setAutoTransform(False)
+    reader.setScaledSize(size)
+    return reader.read()
+
+def supports_region_reads(img_path: str) -> bool:
+    return QImageReader(img_path).supportsOption(QImageIOHandler.ClipRect)
+
+def can_tile(img_path: str) -> bool:
+    # clip rects are in file coordinates, images with an EXIF rotation are shown from the overview only
+    reader = QImageReader(img_path)
+    return reader.size().isValid() and reader.transformation() == QImageIOHandler.TransformationNone
+
+
+class TileLoader(QObject):
+    """
+    Reads pyramid tiles of one image on a thread pool.
+
+    A tile is keyed by (level, column, row), level n holds the image downscaled by 2**n.
+    Requests that are no longer wanted when a worker picks them up are dropped.
+
+    JPEG tiles are region decodes. Other formats cannot decode a region, so a level is decoded whole once, scaled
+    while reading, and tiles are cut from it. Only levels up to LEVEL_BYTES are used for them (min_level), so
+    very large PNG/TIFF files get coarser detail than JPEGs.
+    """
+    loaded = pyqtSignal(tuple, QImage)      # emitted from a worker thread, delivered on the GUI thread
+
+    def __init__(self, img_path: str, original_size: QSize, workers: int = 2, parent=None):
+        super().__init__(parent)
+        self.img_path = img_path
+        self.original_size = original_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.wanted = set()
+        self.pending = set()
+
+        self.region_reads = supports_region_reads(img_path)
+        self.min_level = 0
+        if not self.region_reads:
+            while (original_size.width() >> self.min_level) * (original_size.height() >> self.min_level) * 4 > LEVEL_BYTES:
+                self.min_level += 1
+        self.level_lock = threading.Lock()
+        self.level_image = None     # (level, QImage) of the last whole level decoded
+
+    def tile_rect(self, key: Tuple[int, int, int]) -> QRect:
+        # area of the original image covered by a tile
+        level, column, row = key
+        span = TILE_SIZE << level
+        return QRect(column * span, row * span, span, span).intersected(QRect(0, 0, self.original_size.width(), self.original_size.height()))
+
+    def level_size(self, level: int) -> QSize:
+        return QSize(max(1, self.original_size.width() >> level), max(1, self.original_size.height() >> level))
+
+    def cut_tile(self, key: Tuple[int, int, int], size: QSize) -> QImage:
+        level = key[0]
+        with self.level_lock:
+            # one worker decodes the level, the others wait and cut their tiles from it
+            if self.level_image is None or self.level_image[0] != level:
+                self.level_image = (level, read_level(self.img_path, self.level_size(level)))
+            image = self.level_image[1]
+
+        rect = self.tile_rect(key)
+        return image.copy(QRect(rect.x() >> level, rect.y() >> level, size.width(), size.height()))
+
+    def request(self, keys: Iterable[Tuple[int, int, int]]) -> None:
+        # replaces the wanted set with the tiles of the whole viewport, tiles queued for an old viewport are skipped
+        with self.lock:
+            self.wanted = set(keys)
+            new_keys = self.wanted - self.pending
+            self.pending |= new_keys
+
+        for key in new_keys:
+            self.executor.submit(self.load, key)
+
+    def load(self, key: Tuple[int, int, int]) -> None:
+        with self.lock:
+            if key not in self.wanted:
+                self.pending.discard(key)
+                return
+
+        rect = self.tile_rect(key)
+        level = key[0]
+        size = QSize(max(1, rect.width() >> level), max(1, rect.height() >> level))
+        if self.region_reads:
+            image = read_tile(self.img_path, rect, size)
+        else:
+            image = self.cut_tile(key, size)
+
+        with self.lock:
+            self.pending.discard(key)
+        self.loaded.emit(key, image)
+
+    def close(self) -> None:
+        with self.lock:
+            self.wanted = set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.level_image = None